@@ -0,0 +1,167 @@
+import hashlib
+import re
+from typing import List, Tuple, Optional, Iterable, Set, Sequence
+
+from .utils import get_tag, Log
+
+__all__ = [
+    'collect_selectors', 'prune_css', 'minify_css', 'extract_scripts', 'optimize_styling',
+]
+
+TAG = get_tag(__name__)
+
+# selectors are always kept if they only refer to these
+ALWAYS_KEEP = frozenset(['html', 'body', 'card', 'nightMode', 'night_mode'])
+
+# blocks whose content is kept as is
+KEEP_AT_RULES = ('@font-face', '@keyframes', '@-webkit-keyframes', '@page', '@counter-style')
+
+# blocks containing nested rules
+NESTED_AT_RULES = ('@media', '@supports', '@document', '@layer')
+
+_token = re.compile(r'url\([^)"\']*\)|"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*[\s\S]*?\*/|[{};]|[^"\'{};/]+|/')
+_tag = re.compile(r'<([a-zA-Z][\w-]*)')
+_class = re.compile(r'\sclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+_id = re.compile(r'\sid\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+_selector_strip = re.compile(r'\[[^\]]*\]|::?[\w-]+(?:\([^)]*\))?|"[^"]*"|\'[^\']*\'')
+_selector_name = re.compile(r'([.#]?)(-?[_a-zA-Z][\w-]*|\*)')
+_script = re.compile(r'<script\b[^>]*>([\s\S]*?)</script\s*>\s*', re.I)
+_style = re.compile(r'(<style\b[^>]*>)([\s\S]*?)(</style\s*>)', re.I)
+
+
+def collect_selectors(html_list: Iterable[str]) -> Set[str]:
+    names = set()
+    for html_str in html_list:
+        names.update(m.lower() for m in _tag.findall(html_str))
+        for m in _class.finditer(html_str):
+            names.update('.' + c for c in (m.group(1) or m.group(2)).split())
+        for m in _id.finditer(html_str):
+            names.add('#' + (m.group(1) or m.group(2) or m.group(3)))
+    return names
+
+
+def _tokens(css: str) -> List[str]:
+    return [t for t in _token.findall(css) if not t.startswith('/*')]
+
+
+# returns ([(prelude, body)], next index), body is None for statements, nested rules for
+# NESTED_AT_RULES and a token list otherwise
+def _parse(tokens: List[str], i: int = 0) -> Tuple[List[Tuple[str, Optional[list]]], int]:
+    rules = []
+    prelude = []
+    while i < len(tokens):
+        t = tokens[i]
+        if t == '}':
+            return rules, i + 1
+        if t == ';':
+            rules.append((''.join(prelude).strip() + ';', None))
+            prelude = []
+            i += 1
+        elif t == '{':
+            head = ''.join(prelude).strip()
+            prelude = []
+            if head.lower().startswith(NESTED_AT_RULES):
+                body, i = _parse(tokens, i + 1)
+            else:
+                depth, j = 1, i + 1
+                while j < len(tokens) and depth:
+                    depth += {'{': 1, '}': -1}.get(tokens[j], 0)
+                    j += 1
+                body, i = tokens[i + 1:j - 1], j
+            rules.append((head, body))
+        else:
+            prelude.append(t)
+            i += 1
+    return rules, i
+
+
+def _selector_used(selector: str, used: Set[str], keep: Sequence[str]) -> bool:
+    names = _selector_name.findall(_selector_strip.sub(' ', selector))
+    for prefix, name in names:
+        if name == '*' or name in ALWAYS_KEEP:
+            continue
+        if any(name.startswith(k) for k in keep):
+            continue
+        if (prefix + name if prefix else name.lower()) not in used:
+            return False
+    return True
+
+
+def _prune(rules, used: Set[str], keep: Sequence[str]):
+    pruned = []
+    for head, body in rules:
+        if body is None or head.lower().startswith(KEEP_AT_RULES):
+            pruned.append((head, body))
+        elif head.lower().startswith(NESTED_AT_RULES):
+            body = _prune(body, used, keep)
+            if body:
+                pruned.append((head, body))
+        elif head.startswith('@'):
+            pruned.append((head, body))
+        else:
+            selectors = [s for s in head.split(',') if _selector_used(s, used, keep)]
+            if selectors:
+                pruned.append((','.join(selectors), body))
+    return pruned
+
+
+def _serialize(rules) -> str:
+    parts = []
+    for head, body in rules:
+        if body is None:
+            parts.append(head)
+        elif head.lower().startswith(NESTED_AT_RULES):
+            parts.append(head + '{' + _serialize(body) + '}')
+        else:
+            parts.append(head + '{' + ''.join(body) + '}')
+    return '\n'.join(parts)
+
+
+def prune_css(css: str, used: Set[str], keep: Sequence[str] = ()) -> str:
+    rules, _ = _parse(_tokens(css))
+    return _serialize(_prune(rules, used, keep))
+
+
+def minify_css(css: str) -> str:
+    out = []
+    for t in _tokens(css):
+        if t[0] in '"\'' or t.startswith('url('):
+            out.append(t)
+            continue
+        t = re.sub(r'\s+', ' ', t)
+        t = re.sub(r'\s*([,>{};])\s*', r'\g<1>', t)
+        out.append(t)
+    css = ''.join(out)
+    css = re.sub(r'\s*([{};])\s*', r'\g<1>', css)
+    return css.replace(';}', '}').strip()
+
+
+# moves inline scripts out of html_str, returns (html without scripts, [(file name, script)])
+def extract_scripts(html_str: str) -> Tuple[str, List[Tuple[str, str]]]:
+    scripts = []
+
+    def save(m):
+        script = m.group(1).strip()
+        if script:
+            digest = hashlib.sha1(script.encode('utf8')).hexdigest()[:8]
+            # '_' tells Anki that the file is used by template
+            scripts.append((f"_script-{digest}.js", script))
+        return ''
+
+    return _script.sub(save, html_str), scripts
+
+
+def optimize_styling(styling: str, used: Set[str], keep: Sequence[str] = ()) -> Tuple[str, List[Tuple[str, str]]]:
+    styling, scripts = extract_scripts(styling)
+
+    def optimize(css):
+        size = len(css)
+        css = minify_css(prune_css(css, used, keep))
+        Log.d(TAG, f"css optimized from {size} to {len(css)} chars")
+        return css
+
+    if _style.search(styling):
+        styling = _style.sub(lambda m: m.group(1) + optimize(m.group(2)) + m.group(3), styling)
+    else:
+        styling = optimize(styling)
+    return styling.strip() + '\n', scripts
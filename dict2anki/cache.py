@@ -0,0 +1,71 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from .utils import valid_path, get_tag, Log
+
+__all__ = [
+    'NegativeCache',
+]
+
+TAG = get_tag(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'dict2anki')
+
+# words not found are looked up again after this many seconds, the dictionary may have added them
+DEFAULT_NEGATIVE_TTL = 7 * 24 * 3600
+
+
+# remembers words a dictionary doesn't have, persisted to path if given
+class NegativeCache:
+    def __init__(self, path: Optional[str] = None, ttl: float = DEFAULT_NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        # word -> expiry time since epoch, kept across runs
+        self._entries: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        if path and os.path.isfile(path):
+            try:
+                with open(path, encoding='utf8') as fp:
+                    now = time.time()
+                    self._entries = {k: v for k, v in json.load(fp).items() if v > now}
+            except (OSError, ValueError, AttributeError) as e:
+                Log.w(TAG, f"can't read negative cache: {path}, {e}")
+
+    @staticmethod
+    def _key(word: str) -> str:
+        return ' '.join(word.lower().split())
+
+    def __contains__(self, word: str) -> bool:
+        with self._lock:
+            return self._entries.get(self._key(word), 0) > time.time()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, word: str):
+        with self._lock:
+            self._entries[self._key(word)] = time.time() + self.ttl
+            self._dirty = True
+
+    def discard(self, word: str):
+        with self._lock:
+            if self._entries.pop(self._key(word), None) is not None:
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            try:
+                with open(valid_path(self.path), 'w', encoding='utf8') as fp:
+                    json.dump(self._entries, fp, ensure_ascii=False)
+                self._dirty = False
+            except OSError as e:
+                Log.w(TAG, f"can't write negative cache: {self.path}, {e}")
+            else:
+                Log.d(TAG, 'negative cache saved', path=self.path, words=len(self._entries))
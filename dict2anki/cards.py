@@ -0,0 +1,88 @@
+import csv
+import gzip
+import io
+import itertools
+import os
+from typing import List, Iterable, IO
+
+from .utils import get_tag, Log
+
+__all__ = [
+    'FORMAT_CSV', 'FORMAT_TSV', 'FORMATS', 'write_cards', 'read_cards',
+]
+
+TAG = get_tag(__name__)
+
+FORMAT_CSV = 'csv'
+# Anki's native plain text format, see https://docs.ankiweb.net/importing/text-files.html
+FORMAT_TSV = 'tsv'
+FORMATS = (FORMAT_CSV, FORMAT_TSV)
+
+TSV_HEADER = '#separator:tab\n#html:true\n'
+
+# rows are serialized into a reused buffer, flushed to the file once it exceeds this many chars
+BUFFER_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+_SEPARATORS = {'comma': ',', 'semicolon': ';', 'tab': '\t', 'space': ' ', 'pipe': '|', 'colon': ':'}
+
+# tabs and line breaks are plain whitespace in html, so fields never need quoting
+_TSV_ESCAPE = str.maketrans('\t\r\n', '   ')
+
+
+def _open(path: str, mode: str, compress: bool) -> IO[str]:
+    if compress:
+        return gzip.open(path, mode + 't', encoding='utf8', newline='')
+    return open(path, mode, encoding='utf8', newline='')
+
+
+def _tsv_field(field: str) -> str:
+    field = field.translate(_TSV_ESCAPE)
+    # a leading quote starts a quoted field
+    if field.startswith('"'):
+        field = '"' + field.replace('"', '""') + '"'
+    return field
+
+
+def write_cards(path: str, cards: Iterable[List[str]], card_format: str = FORMAT_CSV, compress: bool = False) -> int:
+    if card_format not in FORMATS:
+        raise ValueError(f"unknown card format: {card_format}")
+    new = not os.path.isfile(path) or os.path.getsize(path) == 0
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    count = 0
+    with _open(path, 'a', compress) as fp:
+        if card_format == FORMAT_TSV and new:
+            fp.write(TSV_HEADER)
+        for card in cards:
+            if card_format == FORMAT_TSV:
+                buffer.write('\t'.join(map(_tsv_field, card)))
+                buffer.write('\n')
+            else:
+                writer.writerow(card)
+            count += 1
+            if buffer.tell() >= BUFFER_SIZE:
+                fp.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+        fp.write(buffer.getvalue())
+    Log.d(TAG, 'cards written', path=path, format=card_format, count=count)
+    return count
+
+
+# reads cards written in any format, compressed or not
+def read_cards(path: str) -> List[List[str]]:
+    if not os.path.isfile(path):
+        return []
+    with open(path, 'rb') as fp:
+        compress = fp.read(2) == GZIP_MAGIC
+    with _open(path, 'r', compress) as fp:
+        delimiter = ','
+        line = fp.readline()
+        while line.startswith('#'):
+            if line.startswith('#separator:'):
+                separator = line.rstrip('\r\n')[len('#separator:'):]
+                delimiter = _SEPARATORS.get(separator.lower(), separator)
+            line = fp.readline()
+        return list(csv.reader(itertools.chain([line], fp), delimiter=delimiter))
@@ -1,47 +1,155 @@
 import argparse
+import functools
 import os
 import socket
-from typing import List, Tuple
 
-from .extractors import EXTRACTORS, DEFAULT_EXTRACTOR
+from .extractors import EXTRACTORS, DEFAULT_EXTRACTOR, RuleExtractor
+from .cache import NegativeCache, DEFAULT_CACHE_DIR, DEFAULT_NEGATIVE_TTL
+from .cards import FORMATS, FORMAT_CSV
+from .extractors.extractor import DEFAULT_MAX_PAGE_SIZE, DEFAULT_CONCURRENCY, BACKENDS, BACKEND_THREAD
+from .snapshot import Snapshot
 from .utils import get_tag, Log
 
 TAG = get_tag(__name__)
 
 DEFAULT_TIME_OUT = 20
 
+DEFAULT_WARM_UP = 2
 
-def parse_args() -> Tuple[str, str, List[str]]:
-    parser = argparse.ArgumentParser(
-        prog='dict2anki',
-        description='dict2anki is a tool converting words to Anki cards.'
-    )
+LOG_LEVELS = {'debug': Log.DEBUG, 'info': Log.INFO, 'warn': Log.WARN, 'error': Log.ERROR}
+DEFAULT_LOG_LEVEL = 'info'
+
+
+def _add_common_arguments(parser: argparse.ArgumentParser):
     parser.add_argument(
-        '-i', '--input-file', metavar='FILE', type=argparse.FileType('r'), required=True,
+        '-i', '--input-file', metavar='FILE', type=argparse.FileType('r'),
         help='read words from FILE split by lines, ignoring lines starting with "#"'
     )
     parser.add_argument(
         '-o', '--output-path', metavar='PATH', help='set output path'
     )
     parser.add_argument(
-        '-e', '--extractor', metavar='DICT', default=DEFAULT_EXTRACTOR,
+        '-e', '--extractor', metavar='DICT',
         choices=EXTRACTORS.keys(),
         help=f"available extractors: {', '.join(EXTRACTORS.keys())}, default: {DEFAULT_EXTRACTOR}"
     )
+    parser.add_argument(
+        '-r', '--rules', metavar='FILE',
+        help='extract cards with the JSON rule FILE instead of a built-in extractor'
+    )
+    parser.add_argument(
+        '--backend', choices=BACKENDS,
+        help=f"how words are run: in a thread pool, in processes for CPU bound offline replay, "
+             f"or one by one for debugging, default: {BACKEND_THREAD}"
+    )
+    parser.add_argument(
+        '--workers', metavar='N', type=int,
+        help='size of the thread or process pool, default: twice the concurrency for threads, CPU count for processes'
+    )
+    parser.add_argument(
+        '--concurrency', metavar='N', type=int,
+        help=f"look up at most N words at once, default: {DEFAULT_CONCURRENCY}"
+    )
+    parser.add_argument(
+        '--word-timeout', metavar='SECONDS', type=float,
+        help='give up a word if looking it up takes longer than SECONDS in total, including retries'
+    )
+    parser.add_argument(
+        '--warm-up', metavar='N', type=int,
+        help=f"connect N times to each dictionary host before looking up words, 0 to disable, "
+             f"default: {DEFAULT_WARM_UP}"
+    )
+    parser.add_argument(
+        '--missing-ttl', metavar='HOURS', type=float,
+        help=f"skip words found missing in the last HOURS without looking them up, 0 to disable, "
+             f"default: {DEFAULT_NEGATIVE_TTL // 3600}"
+    )
     parser.add_argument(
         '-d', '--debug', action='store_true',
         help='show debug info'
     )
-    
+    parser.add_argument(
+        '--log-file', metavar='FILE',
+        help='also write structured logs to FILE as JSON lines'
+    )
+    parser.add_argument(
+        '--log-level', choices=LOG_LEVELS.keys(),
+        help=f"lowest level of logs written to the log file, default: {DEFAULT_LOG_LEVEL}"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='dict2anki',
+        description='dict2anki is a tool converting words to Anki cards.'
+    )
+    _add_common_arguments(parser)
+    # only on the main parser, defaults of a subparser would overwrite options given before its command
+    parser.set_defaults(backend=BACKEND_THREAD, concurrency=DEFAULT_CONCURRENCY, warm_up=DEFAULT_WARM_UP,
+                        missing_ttl=DEFAULT_NEGATIVE_TTL / 3600, log_level=DEFAULT_LOG_LEVEL)
+    parser.add_argument(
+        '--offline', metavar='SNAPSHOT',
+        help='read pages from SNAPSHOT created by the "snapshot" command instead of the network'
+    )
+    parser.add_argument(
+        '--validate-only', action='store_true',
+        help='only check if words exist without fetching their pages, printing missing ones'
+    )
+    parser.add_argument(
+        '--optimize-assets', action='store_true',
+        help='prune styling to what the cards use, minify it and move scripts to media files'
+    )
+    parser.add_argument(
+        '--max-page-size', metavar='MB', type=float, default=DEFAULT_MAX_PAGE_SIZE / 1024 / 1024,
+        help=f"skip words whose page is larger than MB, default: {DEFAULT_MAX_PAGE_SIZE // 1024 // 1024}"
+    )
+    parser.add_argument(
+        '--card-format', choices=FORMATS, default=FORMAT_CSV,
+        help=f"format of the cards file, tsv is Anki's native format with minimal escaping, default: {FORMAT_CSV}"
+    )
+    parser.add_argument(
+        '--gzip', action='store_true',
+        help='compress the cards file with gzip'
+    )
+    parser.add_argument(
+        '--hedge', action='store_true',
+        help='also send a duplicate lookup for words taking longer than 95%% of the others, using the first response'
+    )
+    parser.add_argument(
+        '--prefetch', action='store_true',
+        help='prefetch pages of related words found in pages if they are later in the word list'
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    snapshot_parser = subparsers.add_parser(
+        'snapshot', argument_default=argparse.SUPPRESS,
+        help='save dictionary pages of words to an archive for offline use'
+    )
+    _add_common_arguments(snapshot_parser)
+    snapshot_parser.add_argument(
+        'archive', metavar='ARCHIVE', help='path of the snapshot archive to create'
+    )
+
     args = parser.parse_args()
 
+    if not args.input_file:
+        parser.error('the following arguments are required: -i/--input-file')
+
     if args.debug:
         Log.level = Log.DEBUG
-    
-    if args.extractor == DEFAULT_EXTRACTOR:
-        Log.i(TAG, f"no extractor specified, using default: {DEFAULT_EXTRACTOR}")
+    if args.log_file:
+        Log.open_file(args.log_file, LOG_LEVELS[args.log_level])
+
+    if args.rules:
+        if args.extractor:
+            parser.error('-e/--extractor and -r/--rules are mutually exclusive')
+        name = os.path.splitext(os.path.basename(args.rules))[0]
+    else:
+        if not args.extractor:
+            args.extractor = DEFAULT_EXTRACTOR
+            Log.i(TAG, f"no extractor specified, using default: {DEFAULT_EXTRACTOR}")
+        name = args.extractor
 
-    output_path = os.path.join(args.output_path or os.curdir, args.extractor)
+    args.output_path = os.path.join(args.output_path or os.curdir, name)
 
     Log.d(TAG, f"loading words from {args.input_file.name}")
     words = []
@@ -50,20 +158,54 @@ def parse_args() -> Tuple[str, str, List[str]]:
             line = line.strip()
             if line and not line.startswith('#'):
                 words.append(line)
-                
+    args.words = words
+
     Log.d(TAG, f"{len(words)} words loaded")
-    
-    return args.extractor, output_path, words
+
+    return args
 
 
 def main():
-    extractor_name, output_path, words = parse_args()
+    args = parse_args()
 
     socket.setdefaulttimeout(DEFAULT_TIME_OUT)
 
-    extractor_class = EXTRACTORS[extractor_name]
-    extractor = extractor_class(output_path)
-    extractor.generate_front_template()
-    extractor.generate_back_template()
-    extractor.generate_styling()
-    extractor.generate_cards(*words)
+    if args.rules:
+        extractor_class = functools.partial(RuleExtractor, rules=args.rules)
+    else:
+        extractor_class = EXTRACTORS[args.extractor]
+    negative_cache = None
+    if args.missing_ttl > 0:
+        negative_cache = NegativeCache(
+            os.path.join(DEFAULT_CACHE_DIR, f"missing-{os.path.basename(args.output_path)}.json"),
+            args.missing_ttl * 3600
+        )
+    extractor_class = functools.partial(extractor_class, max_page_size=int(args.max_page_size * 1024 * 1024),
+                                        word_timeout=args.word_timeout, warm_up_connections=args.warm_up,
+                                        negative_cache=negative_cache, backend=args.backend, workers=args.workers,
+                                        concurrency=args.concurrency)
+
+    if args.command == 'snapshot':
+        extractor = extractor_class(args.output_path)
+        extractor.generate_snapshot(args.archive, *args.words)
+        Log.close_file()
+        return
+
+    snapshot = Snapshot(args.offline) if args.offline else None
+    try:
+        extractor = extractor_class(args.output_path, snapshot=snapshot, prefetch=args.prefetch,
+                                    card_format=args.card_format, compress=args.gzip, hedge=args.hedge)
+        if args.validate_only:
+            for word in extractor.validate(*args.words):
+                print(word)
+            return
+        assets_generated = extractor.generate(*args.words)
+        if args.optimize_assets:
+            if assets_generated:
+                extractor.optimize_assets()
+            else:
+                Log.w(TAG, 'assets not optimized as some failed to generate')
+    finally:
+        if snapshot:
+            snapshot.close()
+        Log.close_file()
@@ -2,6 +2,7 @@ from typing import Dict, Type
 
 from .cambridge import *
 from .extractor import *
+from .rule import *
 
 EXTRACTORS: Dict[str, Type[CardExtractor]] = {
     'cambridge': CambridgeExtractor,
@@ -1,12 +1,11 @@
 import os
 import re
-import urllib.parse
-from typing import Tuple, List
+from typing import List
 
-from dict2anki import htmls
-from dict2anki.net import url_get_content, urlopen_with_retry, fake_headers, url_save, url_save_guess_file
+from dict2anki.net import url_get_content, fake_headers, url_save, url_save_guess_file
+from dict2anki.snapshot import SnapshotWriter
 from dict2anki.utils import Log, valid_path, get_tag
-from .extractor import CardExtractor, WordNotFoundError, ExtractError
+from .rule import RuleExtractor
 
 __all__ = [
     'CambridgeExtractor',
@@ -19,10 +18,6 @@ DEFAULT_OUT_PATH = os.path.join(os.curdir, TAG)
 DEFAULT_FRONT_TEMPLATE = '''<hr>
 <div style="text-align:center">{{正面}}</div>'''
 
-URL_ROOT = 'https://dictionary.cambridge.org/'
-
-URL_QUERY = 'https://dictionary.cambridge.org/zhs/%E8%AF%8D%E5%85%B8/%E8%8B%B1%E8%AF%AD-%E6%B1%89%E8%AF%AD-%E7%AE%80%E4%BD%93/{}'
-
 URL_STYLE = 'https://dictionary.cambridge.org/zhs/common.css'
 
 URL_FONT = 'https://dictionary.cambridge.org/zhs/external/fonts/cdoicons.woff'
@@ -33,18 +28,12 @@ URL_AMP_AUDIO = 'https://cdn.ampproject.org/v0/amp-audio-0.1.js'
 
 URL_AMP_ACCORDION = 'https://cdn.ampproject.org/v0/amp-accordion-0.1.js'
 
-THRESHOLD_COLLAPSE = 4096
-
-HTML_COLLAPSE = '<amp-accordion><section>{}</section></amp-accordion>'
-
-HTML_COLLAPSE1 = '<amp-accordion><section>' \
-                 '<header class="ca_h daccord_h"><i class="i i-plus ca_hi"></i>{}</header>{}' \
-                 '</section></amp-accordion>'
 
-parse_tag = re.compile(r'^(<[\s\S]*?>)([\s\S]*)(</[\s\S]*>)$')
+class CambridgeExtractor(RuleExtractor):
+    RULES = os.path.join(os.path.dirname(__file__), 'cambridge.json')
 
-
-class CambridgeExtractor(CardExtractor):
+    # classes and elements created at runtime by AMP scripts
+    KEEP_SELECTORS = ('i-amphtml', 'amp-')
 
     def __init__(self, out_path: str = DEFAULT_OUT_PATH, **kwargs):
         super().__init__(out_path, **kwargs)
@@ -52,10 +41,21 @@ class CambridgeExtractor(CardExtractor):
         self._styling = None
 
     def generate_styling(self):
+        if not self._styling and self.snapshot is not None:
+            self._styling = self._load_assets()
         if not self._styling:
             self._styling = self._retrieve_styling()
         super().generate_styling()
 
+    def warm_up_urls(self) -> List[str]:
+        urls = super().warm_up_urls()
+        return urls + [URL_STYLE, URL_AMP] if self.snapshot is None and not self._styling else urls
+
+    def _save_assets(self, writer: SnapshotWriter):
+        if not self._styling:
+            self._styling = self._retrieve_styling()
+        super()._save_assets(writer)
+
     def _retrieve_styling(self) -> str:
         Log.i(TAG, 'retrieving styling')
         style = url_get_content(URL_STYLE, fake_headers())
@@ -84,86 +84,3 @@ class CambridgeExtractor(CardExtractor):
         
         Log.i(TAG, 'retrieved styling')
         return style
-
-    def get_card(self, word: str) -> Tuple[str, List[str]]:
-        Log.d(TAG, f"querying \"{word}\"")
-        quoted_word = urllib.parse.quote(word.replace('/', ' '))
-        response = urlopen_with_retry(
-            URL_QUERY.format(quoted_word),
-            fake_headers()
-        )
-        
-        final_url_path = urllib.parse.urlsplit(response.geturl()).path
-        actual = final_url_path.rsplit('/', 1)[-1]
-        actual = actual.replace('-', ' ')
-        
-        if not actual:
-            raise WordNotFoundError(f"can't find: \"{word}\"")
-            
-        # Normalize for redirect check
-        normalized_word = ' '.join(word.replace('/', ' ').replace('-', ' ').replace("'", ' ').lower().split())
-        if actual != normalized_word:
-            Log.i(TAG, f"redirected \"{word}\" to: \"{actual}\"")
-            
-        content = url_get_content(response, fake_headers())
-        fields = self._extract_fields(content)
-        Log.d(TAG, f"parsed: \"{actual}\"")
-        return actual, fields
-
-    def _extract_fields(self, html_str: str) -> List[str]:
-        try:
-            back = htmls.find(html_str, 'div', 'class="di-body"')
-            front = htmls.find(back, 'div', 'class="di-title"')
-
-            ipa = htmls.find(back, 'span', 'class="ipa"')
-            if ipa:
-                front += f'<div class="large-ipa">/{ipa}/</div>'
-
-            audio_matches = re.findall(r'src="(/zhs/media[^"]+)"', back)
-            if audio_matches:
-                selected_audio = next((a for a in audio_matches if 'us_pron' in a), audio_matches[0])
-                audio_url = URL_ROOT + selected_audio.lstrip('/')
-                front += f'<audio src="{audio_url}" autoplay controls></audio>'
-
-            # remove titles
-            back = htmls.removeall(back, 'div', 'class="di-title"')
-            
-            # support online audios
-            back = re.sub(r'src="/zhs/media', f'src="{URL_ROOT}zhs/media', back)
-            
-            # remove unwanted elements
-            to_remove = [
-                ('div', 'class="xref'),
-                ('div', 'class="cid"'),
-                ('div', 'class="dwl hax"'),
-                ('div', 'class="hfr lpb-2"'),
-                ('div', 'class="daccord"'),
-                ('script', ''),
-                ('div', 'ad_contentslot'),
-                ('div', 'class="bb hax"'),
-            ]
-            for tag, attr in to_remove:
-                back = htmls.removeall(back, tag, attr)
-
-            def remove_tag(h):
-                return parse_tag.sub(r'\g<2>', h)
-
-            # remove links/underlines but keep text
-            back = htmls.sub(back, remove_tag, 'a', 'class="query"')
-            back = htmls.sub(back, remove_tag, 'a', 'href=')
-            back = htmls.sub(back, remove_tag, 'span', 'class="x-h dx-h"')
-
-            # collapse long cards
-            if len(back) > THRESHOLD_COLLAPSE:
-                back = self._collapse(back)
-            return [front, back]
-        except Exception as e:
-            raise ExtractError('can\'t extract fields', e)
-
-    def _collapse(self, html_str: str) -> str:
-        def collapse1(h):
-            header = htmls.find(htmls.find(h, 'div', 'def-body ddef_b'), 'span', 'trans dtrans dtrans-se')
-            return HTML_COLLAPSE1.format(header, h)
-
-        html_str = htmls.sub(html_str, collapse1, 'div', 'def-block ddef_block')
-        return html_str
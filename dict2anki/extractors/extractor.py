@@ -1,13 +1,24 @@
 import asyncio
-import csv
+import bisect
+import functools
 import os
+import sys
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from typing import Tuple, List
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Tuple, List, Optional, Callable, Any, Dict, Iterable, Set, Union, Awaitable, TextIO
 
+from dict2anki.assets import collect_selectors, optimize_styling
+from dict2anki.cache import NegativeCache
+from dict2anki.cards import FORMAT_CSV, write_cards, read_cards
+from dict2anki.net import DeadlineExceededError, deadline, remaining_time, warm_up
+from dict2anki.snapshot import Snapshot, SnapshotWriter, normalize_word
 from dict2anki.utils import valid_path, Log, get_tag, ProgressBar
 
 __all__ = [
     'WordNotFoundError', 'ExtractError', 'CardExtractor',
+    'BACKEND_THREAD', 'BACKEND_PROCESS', 'BACKEND_SYNC', 'BACKENDS',
 ]
 
 TAG = get_tag(__name__)
@@ -36,6 +47,32 @@ DEFAULT_STYLING = '''.card {
 
 DEFAULT_CONCURRENCY = 8
 
+# words run in a dedicated thread pool
+BACKEND_THREAD = 'thread'
+# cards are extracted in worker processes, for CPU bound work such as replaying a snapshot
+BACKEND_PROCESS = 'process'
+# everything runs one at a time in order on the event loop, assets before words, for debugging
+BACKEND_SYNC = 'sync'
+BACKENDS = (BACKEND_THREAD, BACKEND_PROCESS, BACKEND_SYNC)
+
+# a lookup running longer than this percentile of finished ones is hedged with a duplicate
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+
+# time given to a lookup past its deadline to stop by itself before its slot is freed anyway
+DEADLINE_GRACE = 1
+
+# related words are prefetched at low priority by a few extra workers
+PREFETCH_CONCURRENCY = 2
+# pages prefetched but not yet used are held until their word's turn, related words are dropped beyond this many
+PREFETCH_MAX_PAGES = 16
+
+# pages larger than this are skipped, bounding the memory used by each worker
+DEFAULT_MAX_PAGE_SIZE = 32 * 1024 * 1024
+
+ASSET_STYLING = 'styling'
+ASSET_MEDIA_PREFIX = 'media/'
+
 
 class WordNotFoundError(Exception):
     pass
@@ -45,20 +82,134 @@ class ExtractError(Exception):
     pass
 
 
+def _call_with_deadline(func: Callable[[str], Any], word: str, end: Optional[float]) -> Any:
+    with deadline(None if end is None else end - time.monotonic()):
+        return func(word)
+
+
+# the extractor of a worker process, sent once when the process starts
+_worker_extractor: Optional['CardExtractor'] = None
+
+
+def _init_worker(extractor: 'CardExtractor'):
+    global _worker_extractor
+    _worker_extractor = extractor
+
+
+def _call_worker(name: str, word: str) -> Any:
+    return getattr(_worker_extractor, name)(word)
+
+
+def _page_key(word: str) -> str:
+    return normalize_word(word.replace('-', ' ')).lower()
+
+
+# fetches pages of related words which are later in the word list, so that their queries become cache hits
+class _Prefetcher:
+    def __init__(self, fetch: Callable[[str], Tuple[str, str]], words: Iterable[str]):
+        self._fetch = fetch
+        self._pending: Set[str] = {_page_key(w) for w in words}
+        self._pages: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(PREFETCH_CONCURRENCY, thread_name_prefix='prefetch')
+        self._in_flight = 0
+        self.prefetched = 0
+        self.hits = 0
+
+    # whether as many pages as allowed are held, in flight or waiting to be used
+    @property
+    def full(self) -> bool:
+        return len(self._pages) >= PREFETCH_MAX_PAGES
+
+    def add(self, words: Iterable[str]):
+        with self._lock:
+            for word in words:
+                key = _page_key(word)
+                if key not in self._pending or key in self._pages:
+                    continue
+                # low priority, related words are dropped rather than queued when all workers are busy
+                if self._in_flight >= PREFETCH_CONCURRENCY or self.full:
+                    break
+                Log.d(TAG, 'prefetching "{}"', word)
+                self._in_flight += 1
+                self.prefetched += 1
+                self._pages[key] = self._executor.submit(self._run, word)
+
+    def _run(self, word: str) -> Tuple[str, str]:
+        try:
+            return self._fetch(word)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    # returns the prefetched page of word, waiting for it if still in flight, or None if not prefetched or failed
+    def take(self, word: str) -> Optional[Tuple[str, str]]:
+        key = _page_key(word)
+        with self._lock:
+            self._pending.discard(key)
+            future = self._pages.pop(key, None)
+        if future is None:
+            return None
+        try:
+            result = future.result(remaining_time())
+        except Exception as e:
+            # the word is looked up again, with retries and the negative cache
+            Log.d(TAG, f"prefetching \"{word}\" failed: {e}")
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    # nothing is queued as prefetches never exceed the workers, those running are left to finish
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
 class CardExtractor(metaclass=ABCMeta):
+    # selectors with names starting with these are never pruned, e.g. those added by scripts
+    KEEP_SELECTORS: Tuple[str, ...] = ()
 
     def __init__(self, out_path: str = DEFAULT_OUT_PATH, media_folder: str = DEFAULT_MEDIA_FOLDER,
                  front: str = DEFAULT_FRONT_TEMPLATE_FILE, back: str = DEFAULT_BACK_TEMPLATE_FILE,
-                 styling: str = DEFAULT_STYLING_FILE, cards: str = DEFAULT_CARDS_FILE):
+                 styling: str = DEFAULT_STYLING_FILE, cards: str = DEFAULT_CARDS_FILE,
+                 snapshot: Optional[Snapshot] = None, max_page_size: Optional[int] = DEFAULT_MAX_PAGE_SIZE,
+                 prefetch: bool = False, card_format: str = FORMAT_CSV, compress: bool = False,
+                 word_timeout: Optional[float] = None, hedge: bool = False, warm_up_connections: int = 0,
+                 negative_cache: Optional[NegativeCache] = None, backend: Union[str, Executor] = BACKEND_THREAD,
+                 workers: Optional[int] = None, concurrency: int = DEFAULT_CONCURRENCY):
         self.out_path = out_path
         self.media_path = os.path.join(out_path, media_folder)
         self.front_template_file = os.path.join(out_path, front)
         self.back_template_file = os.path.join(out_path, back)
         self.styling_file = os.path.join(out_path, styling)
-        self.cards_file = os.path.join(out_path, cards)
+        self.cards_file = os.path.join(out_path, cards + '.gz' if compress else cards)
+        self.card_format = card_format
+        self.compress = compress
+        self.word_timeout = word_timeout
+        self.hedge = hedge
+        self.warm_up_connections = warm_up_connections
+        self.negative_cache = negative_cache
+        if not isinstance(backend, Executor) and backend not in BACKENDS:
+            raise ValueError(f"unknown backend: {backend}")
+        # a backend name or an executor to run words in
+        self.backend = backend
+        # size of the pool of the backend, independent of how many words are looked up at once
+        self.workers = workers
+        self.concurrency = concurrency
         self._front_template = DEFAULT_FRONT_TEMPLATE
         self._back_template = DEFAULT_BACK_TEMPLATE
         self._styling = DEFAULT_STYLING
+        self.snapshot = snapshot
+        self.max_page_size = max_page_size
+        self.prefetch = prefetch
+        self._prefetcher: Optional[_Prefetcher] = None
+
+    # sent to worker processes, which only extract cards
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_prefetcher'] = None
+        state['negative_cache'] = None
+        return state
 
     def _write_template(self, desc: str, path: str, content: str):
         Log.i(TAG, f"generating {desc}")
@@ -76,54 +227,323 @@ class CardExtractor(metaclass=ABCMeta):
     def generate_styling(self):
         self._write_template('styling', self.styling_file, self._styling)
 
-    def generate_cards(self, *words: str):
-        Log.i(TAG, f"generating {len(words)} cards")
-        file_path = valid_path(self.cards_file)
-
-        visited = set()
+    # runs func(word) in the thread pool, with a total deadline on requests if word_timeout is set; if hedge is
+    # set, a duplicate is started when the word takes longer than most, and the first to succeed is used;
+    # negative_cache is checked and updated here for funcs running where it isn't available, e.g. in processes
+    async def _map_words_async(self, func: Callable[[str], Any], words: Tuple[str, ...],
+                               extra: Callable[[Any], str], hedge: bool = False,
+                               executor: Optional[Executor] = None, stream: Optional[TextIO] = None,
+                               negative_cache: Optional[NegativeCache] = None) -> Tuple[List[Any], List[str]]:
         skipped = []
-        bar = ProgressBar(len(words))
-        
-        async def process_word(sem: asyncio.Semaphore, word: str) -> List[str]:
+        bar = ProgressBar(len(words), stream=stream)
+        loop = asyncio.get_running_loop()
+        # sorted durations of finished words
+        durations: List[float] = []
+        hedged = 0
+
+        def call(word: str, end: Optional[float]) -> 'asyncio.Future[Any]':
+            future = self._submit(executor, _call_with_deadline, func, word, end)
+            # a losing or abandoned call still finishing in its thread
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return future
+
+        async def first_success(futures: List['asyncio.Future[Any]'], end: Optional[float]) -> Any:
+            pending = set(futures)
+            while True:
+                timeout = None if end is None else end + DEADLINE_GRACE - time.monotonic()
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # threads can't be killed, the slot is freed and the call is left to stop at its deadline
+                    raise DeadlineExceededError(f"timed out after {self.word_timeout}s")
+                future = done.pop()
+                if not pending or future.exception() is None:
+                    return future.result()
+
+        async def lookup(word: str) -> Any:
+            nonlocal hedged
+            if negative_cache is not None and word in negative_cache:
+                raise WordNotFoundError(f"known missing: \"{word}\"")
+            start = time.monotonic()
+            end = None if self.word_timeout is None else start + self.word_timeout
+            futures = [call(word, end)]
+            if hedge and len(durations) >= HEDGE_MIN_SAMPLES:
+                delay = durations[int(HEDGE_PERCENTILE * (len(durations) - 1))]
+                done, _ = await asyncio.wait(futures, timeout=delay)
+                if not done:
+                    Log.d(TAG, 'hedging "{}" after {:.2f}s', word, delay)
+                    hedged += 1
+                    futures.append(call(word, end))
+            try:
+                result = await first_success(futures, end)
+            except WordNotFoundError:
+                if negative_cache is not None:
+                    negative_cache.add(word)
+                raise
+            bisect.insort(durations, time.monotonic() - start)
+            return result
+
+        async def process_word(sem: asyncio.Semaphore, word: str) -> Any:
             async with sem:
+                bar.in_flight += 1
                 try:
-                    # Run blocking get_card in thread pool
-                    loop = asyncio.get_running_loop()
-                    actual, fields = await loop.run_in_executor(None, self.get_card, word)
+                    result = await lookup(word)
                 except Exception as e:
-                    Log.e(TAG, f"can't get card: \"{word}\", {e}")
+                    Log.e(TAG, f"can't process: \"{word}\", {e}")
                     skipped.append(word)
                     Log.e(TAG, f"skipped: \"{word}\"")
+                    bar.fail()
                     return None
-                
+                finally:
+                    bar.in_flight -= 1
+
                 # Update progress bar
-                bar.extra = actual
+                bar.extra = extra(result)
                 bar.increment()
+                return result
 
-                if actual not in visited:
-                    visited.add(word)
-                    visited.add(actual)
-                    return fields
-            return None
+        bar.update(force=True)
+        sem = asyncio.Semaphore(1 if self.backend == BACKEND_SYNC else self.concurrency)
+        results = await asyncio.gather(*[process_word(sem, w) for w in words])
+        bar.done()
+        if hedged:
+            Log.i(TAG, f"hedged {hedged} slow lookups")
+        return results, skipped
 
-        async def run_tasks():
-            sem = asyncio.Semaphore(DEFAULT_CONCURRENCY)
-            tasks = [process_word(sem, w) for w in words]
-            return await asyncio.gather(*tasks)
+    def _map_words(self, func: Callable[[str], Any], words: Tuple[str, ...], extra: Callable[[Any], str],
+                   stream: Optional[TextIO] = None) -> Tuple[List[Any], List[str]]:
+        # func may be a closure, it runs in threads even with the process backend
+        return self._run(lambda executor: self._map_words_async(func, words, extra, stream=stream))
 
-        bar.update()
-        results = asyncio.run(run_tasks())
-        cards = [res for res in results if res]
-        bar.done()
-        
-        with open(file_path, 'a', encoding='utf8') as fp:
-            writer = csv.writer(fp)
-            writer.writerows(cards)
-            
+    # runs main in a new event loop, passing the executor words of cards are run in, None for the default one;
+    # with the thread backend the default executor is a dedicated pool shared with everything else
+    def _run(self, main: Callable[[Optional[Executor]], Awaitable[Any]]) -> Any:
+        async def run():
+            if isinstance(self.backend, Executor):
+                return await main(self.backend)
+            if self.backend == BACKEND_THREAD:
+                workers = self.workers or self.concurrency * 2
+                asyncio.get_running_loop().set_default_executor(
+                    ThreadPoolExecutor(workers, thread_name_prefix='worker'))
+            if self.backend != BACKEND_PROCESS:
+                return await main(None)
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self,)) as executor:
+                return await main(executor)
+
+        return asyncio.run(run())
+
+    def _submit(self, executor: Optional[Executor], func: Callable[..., Any], *args: Any) -> 'asyncio.Future[Any]':
+        loop = asyncio.get_running_loop()
+        if self.backend != BACKEND_SYNC:
+            return loop.run_in_executor(executor, func, *args)
+        # blocks the loop until func returns
+        future = loop.create_future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def generate_cards(self, *words: str):
+        self._generate(words)
+
+    # generates templates, styling and cards at once, asset retrieval overlaps word lookups in the same loop
+    # and thread pool; cards are generated even if an asset fails, returns whether all assets succeeded
+    def generate(self, *words: str) -> bool:
+        return self._generate(words, (self.generate_front_template, self.generate_back_template,
+                                      self.generate_styling))
+
+    def _generate(self, words: Tuple[str, ...], generators: Tuple[Callable[[], None], ...] = ()) -> bool:
+        Log.i(TAG, f"generating {len(words)} cards")
+
+        async def run(executor: Optional[Executor]):
+            assets = [self._submit(None, g) for g in generators]
+            if self.warm_up_connections and self.snapshot is None:
+                # connections are warmed before the first batch of words is dispatched
+                await self._submit(None, warm_up, self.warm_up_urls(), self.warm_up_connections, self.word_timeout)
+            get_card = self.get_card
+            negative_cache = None
+            if self.backend == BACKEND_PROCESS:
+                get_card = functools.partial(_call_worker, 'get_card')
+                # workers get no negative cache, words missing from snapshots aren't cached anyway
+                if self.snapshot is None:
+                    negative_cache = self.negative_cache
+            cards = self._map_words_async(get_card, words, lambda r: r[0], self.hedge, executor,
+                                          negative_cache=negative_cache)
+            return await asyncio.gather(*assets, cards, return_exceptions=True)
+
+        # pages are handed over in process
+        if self.prefetch and self.snapshot is None and self.backend != BACKEND_PROCESS:
+            self._prefetcher = _Prefetcher(self._fetch, words)
+        try:
+            *errors, cards = self._run(run)
+        finally:
+            self._save_negative_cache()
+            prefetcher, self._prefetcher = self._prefetcher, None
+            if prefetcher:
+                prefetcher.close()
+                Log.i(TAG, f"prefetched {prefetcher.prefetched} related words, {prefetcher.hits} used")
+        if isinstance(cards, BaseException):
+            raise cards
+
+        self._write_cards(words, *cards)
+        for generator, e in zip(generators, errors):
+            if e is not None:
+                Log.e(TAG, f"can't {generator.__name__.replace('_', ' ')}: {e}")
+        return not any(errors)
+
+    def _write_cards(self, words: Tuple[str, ...], results: List[Any], skipped: List[str]):
+        file_path = valid_path(self.cards_file)
+        visited = set()
+        cards = []
+        for word, result in zip(words, results):
+            if not result:
+                continue
+            actual, fields = result
+            if actual not in visited:
+                visited.add(word)
+                visited.add(actual)
+                cards.append(fields)
+
+        write_cards(file_path, cards, self.card_format, self.compress)
         Log.i(TAG, f"generated {len(cards)} cards to: {file_path}")
         if skipped:
             Log.e(TAG, f"skipped {len(skipped)} words:\n" + "\n".join(skipped))
 
+    def _read_cards(self) -> List[List[str]]:
+        return read_cards(self.cards_file)
+
+    def optimize_assets(self):
+        Log.i(TAG, 'optimizing assets')
+        html_list = [self._front_template, self._back_template]
+        html_list.extend(field for card in self._read_cards() for field in card)
+        styling, scripts = optimize_styling(self._styling, collect_selectors(html_list), self.KEEP_SELECTORS)
+        Log.i(TAG, f"styling optimized from {len(self._styling)} to {len(styling)} chars")
+        self._styling = styling
+
+        tags = []
+        for name, script in scripts:
+            file_path = valid_path(os.path.join(self.media_path, name))
+            with open(file_path, 'w', encoding='utf8') as fp:
+                fp.write(script)
+            Log.i(TAG, f"moved script to: {file_path}")
+            tags.append(f'<script src="{os.path.basename(file_path)}"></script>')
+        if tags:
+            self._front_template = '\n'.join(tags) + '\n' + self._front_template
+
+        self.generate_front_template()
+        self.generate_back_template()
+        self.generate_styling()
+
+    def generate_snapshot(self, path: str, *words: str):
+        Log.i(TAG, f"saving {len(words)} words to snapshot")
+        with SnapshotWriter(path) as writer:
+            def save(word: str) -> str:
+                actual, content = self.query(word)
+                writer.add(word, actual, content)
+                return actual
+
+            if self.warm_up_connections:
+                warm_up(self.warm_up_urls(), self.warm_up_connections, self.word_timeout)
+            try:
+                results, skipped = self._map_words(save, words, lambda r: r)
+            finally:
+                self._save_negative_cache()
+            self._save_assets(writer)
+        Log.i(TAG, f"saved {len(words) - len(skipped)} words to snapshot: {writer.path}")
+        if skipped:
+            Log.e(TAG, f"skipped {len(skipped)} words:\n" + "\n".join(skipped))
+
+    def _save_assets(self, writer: SnapshotWriter):
+        writer.add_asset(ASSET_STYLING, self._styling.encode('utf8'))
+        if os.path.isdir(self.media_path):
+            for name in sorted(os.listdir(self.media_path)):
+                with open(os.path.join(self.media_path, name), 'rb') as fp:
+                    writer.add_asset(ASSET_MEDIA_PREFIX + name, fp.read())
+
+    def _load_assets(self) -> Optional[str]:
+        for name in self.snapshot.asset_names():
+            if name.startswith(ASSET_MEDIA_PREFIX):
+                file_path = valid_path(os.path.join(self.media_path, name[len(ASSET_MEDIA_PREFIX):]))
+                with open(file_path, 'wb') as fp:
+                    fp.write(self.snapshot.get_asset(name))
+                Log.d(TAG, f"restored media file from snapshot: {file_path}")
+        styling = self.snapshot.get_asset(ASSET_STYLING)
+        return styling.decode('utf8') if styling is not None else None
+
+    # urls of hosts queried for words, connected to before generating cards
+    def warm_up_urls(self) -> List[str]:
+        return []
+
+    # called with words related to the one being extracted, they may be prefetched
+    def _on_related(self, words: Iterable[str]):
+        prefetcher = self._prefetcher
+        if prefetcher and not prefetcher.full:
+            prefetcher.add(words)
+
+    def query(self, word: str) -> Tuple[str, str]:
+        prefetcher = self._prefetcher
+        result = prefetcher.take(word) if prefetcher else None
+        if result is not None:
+            Log.d(TAG, 'prefetched: "{}"', word)
+        elif self.snapshot is None:
+            result = self._lookup(self._fetch, word)
+        else:
+            result = self.snapshot.get(word)
+            if result is None:
+                raise WordNotFoundError(f"not in snapshot: \"{word}\"")
+        if self.max_page_size is not None and len(result[1]) > self.max_page_size:
+            raise ExtractError(f"page of \"{word}\" exceeds {self.max_page_size} bytes")
+        return result
+
+    # checks if word exists, returning the actual word, without fetching its page if the dictionary allows
+    def probe(self, word: str) -> str:
+        return self._fetch(word)[0]
+
+    # calls func(word) unless word is known missing, remembering it if func raises WordNotFoundError
+    def _lookup(self, func: Callable[[str], Any], word: str) -> Any:
+        cache = self.negative_cache
+        if cache is not None and word in cache:
+            raise WordNotFoundError(f"known missing: \"{word}\"")
+        try:
+            return func(word)
+        except WordNotFoundError:
+            if cache is not None:
+                cache.add(word)
+            raise
+
+    # returns words the dictionary doesn't have, probing them cheaply
+    def validate(self, *words: str) -> List[str]:
+        Log.i(TAG, f"validating {len(words)} words")
+        missing = []
+
+        def check(word: str) -> str:
+            try:
+                if self.snapshot is not None:
+                    return self.query(word)[0]
+                return self._lookup(self.probe, word)
+            except WordNotFoundError:
+                missing.append(word)
+                return ''
+
+        try:
+            # progress goes to stderr, missing words are usually printed to stdout
+            results, skipped = self._map_words(check, words, lambda r: r, sys.stderr)
+        finally:
+            self._save_negative_cache()
+        Log.i(TAG, f"{len(words) - len(missing) - len(skipped)} words found, {len(missing)} missing")
+        if skipped:
+            Log.e(TAG, f"can't validate {len(skipped)} words:\n" + "\n".join(skipped))
+        missing = set(missing)
+        return [w for w in words if w in missing]
+
+    def _save_negative_cache(self):
+        if self.negative_cache is not None:
+            self.negative_cache.save()
+
+    # returns (actual word, page) from the dictionary, extractors only reading snapshots may not support it
+    def _fetch(self, word: str) -> Tuple[str, str]:
+        raise ExtractError(f"{type(self).__name__} doesn't support raw page queries")
+
     @abstractmethod
     def get_card(self, word: str) -> Tuple[str, List[str]]:
         pass
@@ -0,0 +1,99 @@
+import os
+import urllib.parse
+from http.client import HTTPResponse
+from typing import Tuple, List, Optional
+from urllib.error import HTTPError
+from urllib.request import Request
+
+from dict2anki.cache import DEFAULT_CACHE_DIR
+from dict2anki.net import url_get_content, urlopen_with_retry, fake_headers
+from dict2anki.rules import load_rules
+from dict2anki.snapshot import normalize_word
+from dict2anki.utils import Log, get_tag
+from .extractor import CardExtractor, WordNotFoundError, ExtractError
+
+__all__ = [
+    'RuleExtractor',
+]
+
+TAG = get_tag(__name__)
+
+DEFAULT_OUT_PATH = os.path.join(os.curdir, TAG)
+
+
+class RuleExtractor(CardExtractor):
+    # path of the rule file, see cambridge.json for an example
+    RULES: Optional[str] = None
+
+    def __init__(self, out_path: str = DEFAULT_OUT_PATH, rules: Optional[str] = None,
+                 rules_cache_dir: Optional[str] = DEFAULT_CACHE_DIR, **kwargs):
+        super().__init__(out_path, **kwargs)
+        rules = rules or self.RULES
+        if not rules:
+            raise ValueError('no rule file specified')
+        # compiled rules are cached in rules_cache_dir, None to only cache them in memory
+        self.program = load_rules(rules, rules_cache_dir)
+
+    def get_card(self, word: str) -> Tuple[str, List[str]]:
+        actual, content = self.query(word)
+        # related words are only collected while the prefetcher takes more
+        links = [] if self._prefetcher and not self._prefetcher.full else None
+        fields = self._extract_fields(content, links)
+        Log.d(TAG, 'parsed: "{}"', actual)
+        if links:
+            self._on_related(urllib.parse.unquote(link).replace('-', ' ') for link in links)
+        return actual, fields
+
+    def warm_up_urls(self) -> List[str]:
+        return [self.program.url] if self.program.url else []
+
+    def _fetch(self, word: str) -> Tuple[str, str]:
+        actual, response = self._open(word)
+        content = url_get_content(response, fake_headers(), max_size=self.max_page_size)
+        return actual, content
+
+    # a HEAD request, missing words cost a single round trip without any body
+    def probe(self, word: str) -> str:
+        actual, response = self._open(word, 'HEAD')
+        response.close()
+        return actual
+
+    def _open(self, word: str, method: str = 'GET') -> Tuple[str, HTTPResponse]:
+        if not self.program.url:
+            raise ExtractError(f"no url in rules of {self.program.name}")
+        Log.d(TAG, 'querying "{}"', word, method=method)
+        quoted_word = urllib.parse.quote(word.replace('/', ' '))
+        try:
+            response = urlopen_with_retry(
+                Request(self.program.url.format(quoted_word), method=method),
+                fake_headers()
+            )
+        except HTTPError as e:
+            if e.code in (404, 410):
+                e.close()
+                raise WordNotFoundError(f"can't find: \"{word}\"") from e
+            raise
+
+        actual = normalize_word(word)
+        if self.program.actual == 'redirect':
+            final_url_path = urllib.parse.urlsplit(response.geturl()).path
+            actual = final_url_path.rsplit('/', 1)[-1]
+            actual = actual.replace('-', ' ')
+
+            if not actual:
+                # the body is never read
+                response.close()
+                raise WordNotFoundError(f"can't find: \"{word}\"")
+
+            # Normalize for redirect check
+            normalized_word = ' '.join(word.replace('/', ' ').replace('-', ' ').replace("'", ' ').lower().split())
+            if actual != normalized_word:
+                Log.i(TAG, f"redirected \"{word}\" to: \"{actual}\"")
+
+        return actual, response
+
+    def _extract_fields(self, html_str: str, links: Optional[List[str]] = None) -> List[str]:
+        try:
+            return self.program.run(html_str, links)
+        except Exception as e:
+            raise ExtractError('can\'t extract fields', e)
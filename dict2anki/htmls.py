@@ -1,41 +1,80 @@
+import functools
+import heapq
 import re
-from typing import Optional, Iterator, Tuple, Callable
+from typing import Optional, Iterator, Tuple, Callable, Iterable
 
-from .utils import get_tag, Log
+from .utils import get_tag
 
 __all__ = [
-    'find_positions', 'findall', 'find', 'sub', 'removeall',
+    'Matcher', 'matcher',
+    'find_positions', 'findall', 'find', 'sub', 'removeall', 'removeall_many', 'strip_many',
 ]
 
 TAG = get_tag(__name__)
 
 
+class Matcher:
+    def __init__(self, tag: str, attrib: str = ''):
+        self.tag = tag
+        self.attrib = attrib
+        # tokens starting with '</' are close tags, others open tags
+        self._all_tag = re.compile(rf'</?{tag}\s*?>|<{tag}\s[\s\S]*?>')
+        # only checked on open tags
+        self._start_tag = re.compile(rf'<{tag}[\s\S]*?{attrib}[\s\S]*?>')
+
+    def __repr__(self):
+        return f"Matcher({self.tag!r}, {self.attrib!r})"
+
+    # yields (start, open tag end, close tag start, end) of every matched element in html_str[pos:endpos]
+    def spans(self, html_str: str, pos: int = 0, endpos: Optional[int] = None) -> Iterator[Tuple[int, int, int, int]]:
+        count = 0
+        start = -1
+        open_end = -1
+
+        for m in self._all_tag.finditer(html_str, pos, len(html_str) if endpos is None else endpos):
+            if html_str[m.start() + 1] != '/':
+                if start != -1:
+                    count += 1
+                elif self._start_tag.match(m.group(0)):
+                    count = 1
+                    start, open_end = m.start(), m.end()
+            elif start != -1:
+                count -= 1
+                if count == 0:
+                    yield start, open_end, m.start(), m.end()
+                    start = -1
+
+    def positions(self, html_str: str, hook: Optional[Callable[[int, int], None]] = None,
+                  pos: int = 0, endpos: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+        for start, _, _, end in self.spans(html_str, pos, endpos):
+            if hook:
+                hook(start, end)
+            yield start, end
+
+    # replaces matched elements in html_str[pos:endpos], building the result once
+    def sub(self, html_str: str, replace: Callable[[str], str], pos: int = 0, endpos: Optional[int] = None) -> str:
+        endpos = len(html_str) if endpos is None else endpos
+        parts = []
+        last = pos
+        for i, j in self.positions(html_str, pos=pos, endpos=endpos):
+            segment = html_str[i:j]
+            parts.append(html_str[last:i])
+            parts.append(replace(segment))
+            last = j
+        if not parts and pos == 0 and endpos == len(html_str):
+            return html_str
+        parts.append(html_str[last:endpos])
+        return ''.join(parts)
+
+
+# matchers are cached, so regexes are only compiled once per tag and attrib
+@functools.lru_cache(maxsize=None)
+def matcher(tag: str, attrib: str = '') -> Matcher:
+    return Matcher(tag, attrib)
+
+
 def find_positions(html_str: str, tag: str, attrib: str = '', hook: Optional[Callable[[int, int], None]] = None) -> Iterator[Tuple[int, int]]:
-    open_tag = re.compile(rf'<{tag}(?:\s*?|\s[\s\S]*?)>')
-    close_tag = re.compile(rf'</{tag}\s*?>')
-    all_tag = re.compile(rf'</?{tag}\s*?>|<{tag}\s[\s\S]*?>')
-    # must match with open_tag first
-    start_tag = re.compile(rf'<{tag}[\s\S]*?{attrib}[\s\S]*?>')
-    
-    count = 0
-    start = -1
-    
-    for m in all_tag.finditer(html_str):
-        token = m.group(0)
-        if open_tag.fullmatch(token):
-            if start != -1:
-                count += 1
-            elif start_tag.match(token):
-                count = 1
-                start = m.start()
-        elif start != -1 and close_tag.fullmatch(token):
-            count -= 1
-            if count == 0:
-                Log.d(TAG, f"paired tags found, start={start}, end={m.end()}")
-                if hook:
-                    hook(start, m.end())
-                yield start, m.end()
-                start = -1
+    return matcher(tag, attrib).positions(html_str, hook)
 
 
 def findall(html_str: str, tag: str, attrib: str = '') -> Iterator[str]:
@@ -48,14 +87,41 @@ def find(html_str: str, tag: str, attrib: str = '') -> Optional[str]:
 
 
 def sub(html_str: str, replace: Callable[[str], str], tag: str, attrib: str = '') -> str:
-    positions = list(find_positions(html_str, tag, attrib))
-    
-    for i, j in reversed(positions):
-        segment = html_str[i:j]
-        Log.d(TAG, f"replacing element: {segment}")
-        html_str = html_str[:i] + replace(segment) + html_str[j:]
-    return html_str
+    return matcher(tag, attrib).sub(html_str, replace)
 
 
 def removeall(html_str: str, tag: str, attrib: str = '') -> str:
     return sub(html_str, lambda h: '', tag, attrib)
+
+
+# removes elements matched by remove, and tags of elements matched by unwrap keeping their content, in
+# html_str[pos:endpos]; spans of all matchers are merged in one scan and the result is built once
+def strip_many(html_str: str, remove: Iterable[Matcher] = (), unwrap: Iterable[Matcher] = (),
+               pos: int = 0, endpos: Optional[int] = None) -> str:
+    endpos = len(html_str) if endpos is None else endpos
+
+    def unwrap_spans(m):
+        for i, k, l, j in m.spans(html_str, pos, endpos):
+            yield i, k
+            yield l, j
+
+    # (start, end) spans to delete, each matcher yields them in order so they are merged lazily;
+    # outer spans first, an element matched by both remove and unwrap is removed
+    spans = heapq.merge(*[((i, j) for i, _, _, j in m.spans(html_str, pos, endpos)) for m in remove],
+                        *[unwrap_spans(m) for m in unwrap], key=lambda span: (span[0], -span[1]))
+    parts = []
+    last = pos
+    for i, j in spans:
+        # nested in a span already deleted
+        if i < last:
+            continue
+        parts.append(html_str[last:i])
+        last = j
+    if not parts and pos == 0 and endpos == len(html_str):
+        return html_str
+    parts.append(html_str[last:endpos])
+    return ''.join(parts)
+
+
+def removeall_many(html_str: str, matchers: Iterable[Matcher]) -> str:
+    return strip_many(html_str, remove=matchers)
@@ -1,16 +1,29 @@
+import collections
+import contextlib
+import email.utils
+import http.client
 import mimetypes
 import os
+import random
 import re
 import socket
+import ssl
+import threading
+import time
 import urllib.parse
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPResponse
-from typing import Union, Tuple, Optional, Dict
-from urllib.request import Request, urlopen
+from typing import Union, Tuple, Optional, Dict, Iterator, List, Iterable, Deque, Any
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, HTTPHandler, HTTPSHandler, HTTPRedirectHandler, OpenerDirector, \
+    build_opener
 
 from .utils import valid_path, get_tag, Log
 
 __all__ = [
+    'ContentTooLargeError', 'DeadlineExceededError', 'CircuitBreaker', 'RetryPolicy', 'deadline', 'remaining_time',
+    'DnsCache', 'TlsSessionCache', 'warm_up',
     'fake_headers', 'urlopen_with_retry', 'url_get_content', 'url_save', 'url_save_guess_file',
 ]
 
@@ -28,58 +41,434 @@ def fake_headers() -> Dict[str, str]:
     }
 
 
+class ContentTooLargeError(Exception):
+    pass
+
+
+class DeadlineExceededError(Exception):
+    pass
+
+
+# responses are read in chunks of this size while a deadline is set, checking it in between
+DEADLINE_READ_SIZE = 64 * 1024
+
+_local = threading.local()
+
+
+# bounds the total time of requests made by the current thread in the block, including retries and backoffs;
+# nested deadlines can only shorten it
+@contextlib.contextmanager
+def deadline(timeout: Optional[float]) -> Iterator[None]:
+    previous = getattr(_local, 'deadline', None)
+    if timeout is not None:
+        end = time.monotonic() + timeout
+        _local.deadline = end if previous is None else min(previous, end)
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+# seconds left before the deadline of the current thread, None if there is none
+def remaining_time() -> Optional[float]:
+    end = getattr(_local, 'deadline', None)
+    return None if end is None else end - time.monotonic()
+
+
+def _check_deadline(url) -> Optional[float]:
+    remaining = remaining_time()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceededError(f"deadline exceeded: {url}")
+    return remaining
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 10, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures: Dict[str, int] = {}
+        self._open_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host: str):
+        # pause instead of failing while the host is considered down
+        while True:
+            with self._lock:
+                remaining = self._open_until.get(host, 0) - time.monotonic()
+            if remaining <= 0:
+                return
+            left = _check_deadline(host)
+            Log.w(TAG, f"circuit open for {host}, pausing {remaining:.1f}s")
+            time.sleep(remaining if left is None else min(remaining, left))
+
+    def is_open(self, host: str) -> bool:
+        with self._lock:
+            return self._open_until.get(host, 0) > time.monotonic()
+
+    def success(self, host: str):
+        with self._lock:
+            self._failures[host] = 0
+
+    def failure(self, host: str):
+        with self._lock:
+            failures = self._failures.get(host, 0) + 1
+            self._failures[host] = failures
+            if failures >= self.threshold and self._open_until.get(host, 0) <= time.monotonic():
+                Log.e(TAG, f"{failures} consecutive failures, {host} seems down, pausing {self.cooldown}s")
+                self._open_until[host] = time.monotonic() + self.cooldown
+
+
+DEFAULT_BREAKER = CircuitBreaker()
+
+
+class RetryPolicy:
+    TRANSIENT_CODES = frozenset([408, 425, 429, 500, 502, 503, 504])
+    TRANSIENT_ERRORS = (socket.timeout, ConnectionError, http.client.IncompleteRead, http.client.RemoteDisconnected)
+    # urllib also wraps permanent errors such as failed certificate checks and unknown url types in URLError
+    TRANSIENT_REASONS = (socket.timeout, ConnectionError, socket.gaierror)
+
+    def __init__(self, retry: int = 5, backoff: float = 0.5, factor: float = 2, max_backoff: float = 30,
+                 max_retry_after: float = 120, breaker: Optional[CircuitBreaker] = DEFAULT_BREAKER):
+        self.retry = retry
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker
+
+    def is_transient(self, e: Exception) -> bool:
+        if isinstance(e, HTTPError):
+            return e.code in self.TRANSIENT_CODES
+        if isinstance(e, URLError):
+            return isinstance(e.reason, self.TRANSIENT_REASONS)
+        return isinstance(e, self.TRANSIENT_ERRORS)
+
+    def _retry_after(self, e: Exception) -> Optional[float]:
+        value = e.headers.get('Retry-After') if isinstance(e, HTTPError) and e.headers else None
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt: int, e: Optional[Exception] = None) -> float:
+        retry_after = self._retry_after(e) if e else None
+        if retry_after is not None:
+            return min(max(retry_after, 0), self.max_retry_after)
+        return min(self.backoff * self.factor ** (attempt - 1), self.max_backoff) * random.uniform(0.5, 1)
+
+    def wait(self, host: str):
+        if self.breaker:
+            self.breaker.wait(host)
+
+    def success(self, host: str):
+        if self.breaker:
+            self.breaker.success(host)
+
+    def failure(self, host: str, attempt: int, e: Exception) -> bool:
+        # sleeps for the backoff and returns True if the failed attempt should be retried
+        if not self.is_transient(e):
+            return False
+        if self.breaker:
+            self.breaker.failure(host)
+        if attempt >= self.retry:
+            return False
+        delay = self.delay(attempt, e)
+        remaining = remaining_time()
+        if remaining is not None and delay >= remaining:
+            Log.d(TAG, 'not retrying {}, deadline in {:.2f}s', host, remaining)
+            return False
+        Log.d(TAG, 'retrying {} in {:.2f}s', host, delay)
+        time.sleep(delay)
+        return True
+
+
+# getaddrinfo doesn't tell the TTL of records
+DEFAULT_DNS_TTL = 300
+
+# sessions kept per host, TLS 1.3 tickets are meant to be used once
+DEFAULT_TLS_SESSIONS = 8
+
+
+class DnsCache:
+    def __init__(self, ttl: float = DEFAULT_DNS_TTL):
+        self.ttl = ttl
+        self._entries: Dict[Tuple[str, int], Tuple[float, List[Any]]] = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, host: str, port: int) -> List[Any]:
+        key = (host, port)
+        with self._lock:
+            expires, addresses = self._entries.get(key, (0, None))
+        if addresses and expires > time.monotonic():
+            return addresses
+        addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        Log.d(TAG, 'resolved', host=host, addresses=len(addresses))
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host: str, port: int):
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class TlsSessionCache:
+    def __init__(self, size: int = DEFAULT_TLS_SESSIONS):
+        self.size = size
+        self._sessions: Dict[Tuple[str, int], Deque[ssl.SSLSession]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, host: str, port: int) -> Optional[ssl.SSLSession]:
+        with self._lock:
+            sessions = self._sessions.get((host, port))
+            return sessions.popleft() if sessions else None
+
+    def put(self, host: str, port: int, session: Optional[ssl.SSLSession]):
+        if session is None:
+            return
+        with self._lock:
+            self._sessions.setdefault((host, port), collections.deque(maxlen=self.size)).append(session)
+
+
+DNS_CACHE = DnsCache()
+TLS_SESSIONS = TlsSessionCache()
+
+
+def _create_connection(host: str, port: int, timeout: Any, source_address: Optional[Tuple[str, int]]) -> socket.socket:
+    # like socket.create_connection, but with cached addresses
+    error = None
+    for family, type_, proto, _, address in DNS_CACHE.resolve(host, port):
+        sock = socket.socket(family, type_, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            error = e
+            sock.close()
+    # addresses may be stale
+    DNS_CACHE.invalidate(host, port)
+    raise error or OSError(f"no address for {host}")
+
+
+class _HTTPConnection(http.client.HTTPConnection):
+    def connect(self):
+        self.sock = _create_connection(self.host, self.port, self.timeout, self.source_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._tunnel_host:
+            self._tunnel()
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        self._session_saved = False
+        _HTTPConnection.connect(self)
+        host = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=host,
+                                              session=TLS_SESSIONS.get(host, self.port))
+        Log.d(TAG, 'tls connected', host=host, reused=self.sock.session_reused)
+
+    def _save_session(self):
+        session = getattr(self.sock, 'session', None)
+        if session is not None and not self._session_saved:
+            self._session_saved = True
+            TLS_SESSIONS.put(self._tunnel_host or self.host, self.port, session)
+
+    def getresponse(self):
+        response = super().getresponse()
+        # TLS 1.3 tickets arrive after the handshake, they have been read with the response
+        self._save_session()
+        return response
+
+    def close(self):
+        # urllib asks servers to close connections, the socket is closed before getresponse returns
+        self._save_session()
+        super().close()
+
+
+class _HTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_HTTPConnection, req)
+
+
+class _HTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_HTTPSConnection, req, context=self._context)
+
+
+class _HTTPRedirectHandler(HTTPRedirectHandler):
+    # older versions turn redirected HEAD requests into GET ones, fetching the body probes avoid
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        request = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if request is not None and req.get_method() == 'HEAD':
+            request.method = 'HEAD'
+        return request
+
+
+# sessions can only be resumed with the context they were made with, so connections share one
+def _build_opener(context: ssl.SSLContext) -> OpenerDirector:
+    return build_opener(_HTTPHandler, _HTTPSHandler(context=context), _HTTPRedirectHandler)
+
+
+_opener = _build_opener(ssl.create_default_context())
+
+
+def urlopen(url: Union[str, Request], data: Optional[bytes] = None,
+            timeout: Any = socket._GLOBAL_DEFAULT_TIMEOUT) -> HTTPResponse:
+    return _opener.open(url, data, timeout)
+
+
+# resolves hosts of urls and makes connections to them so that later requests skip DNS lookups and full TLS
+# handshakes, connections are made concurrently and errors are only logged
+def warm_up(urls: Iterable[str], connections: int = 1, timeout: Optional[float] = None):
+    roots = []
+    for url in urls:
+        parts = urllib.parse.urlsplit(url)
+        root = f"{parts.scheme}://{parts.netloc}/"
+        if root not in roots:
+            roots.append(root)
+    if not roots or connections <= 0:
+        return
+
+    def connect(root: str):
+        try:
+            urlopen(Request(root, headers=fake_headers(), method='HEAD'), timeout=timeout).close()
+        except HTTPError as e:
+            e.close()
+        except Exception as e:
+            Log.w(TAG, f"can't warm up {root}: {e}")
+
+    Log.d(TAG, 'warming up', hosts=len(roots), connections=connections)
+    with ThreadPoolExecutor(len(roots) * connections, thread_name_prefix='warm-up') as executor:
+        list(executor.map(connect, roots * connections))
+
+
 def urlopen_with_retry(url: Union[str, Request],
                        headers: Dict[str, str] = None,
                        retry: int = 5,
+                       policy: RetryPolicy = None,
                        **kwargs) -> HTTPResponse:
-    Log.d(TAG, f"urlopen: url={url}, headers={headers}, retry={retry}, kwargs={kwargs}")
+    Log.d(TAG, 'urlopen', url=url, headers=headers, retry=retry, kwargs=kwargs)
     if isinstance(url, str):
         url = Request(url)
     if headers:
         url.headers = headers
-    
-    for i in range(1, retry + 1):
+    policy = policy or RetryPolicy(retry)
+    host = url.host
+
+    attempt = 0
+    while True:
+        attempt += 1
+        policy.wait(host)
         try:
-            return urlopen(url, **kwargs)
+            response = _urlopen_within_deadline(url, **kwargs)
         except Exception as e:
-            Log.w(TAG, f"urlopen attempt {i} error: {e}")
-            if i == retry:
+            Log.w(TAG, f"urlopen attempt {attempt} error: {e}")
+            if not policy.failure(host, attempt, e):
                 raise e
+        else:
+            policy.success(host)
+            return response
+
+
+def _urlopen_within_deadline(url: Request, **kwargs) -> HTTPResponse:
+    remaining = _check_deadline(url.full_url)
+    if remaining is None:
+        return urlopen(url, **kwargs)
+    # each socket operation may take at most the time left
+    timeout = kwargs.get('timeout') or socket.getdefaulttimeout()
+    timeout = remaining if timeout is None else min(timeout, remaining)
+    return urlopen(url, **{**kwargs, 'timeout': timeout})
+
+
+# inflated in chunks appended in place, one-shot inflating briefly holds the result twice when trimming its buffer
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+
+def _decompress(data: bytes, wbits: int, max_size: Optional[int]) -> bytearray:
+    decompressor = zlib.decompressobj(wbits)
+    result = bytearray()
+    while data:
+        result += decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+        # stop inflating as soon as the limit is exceeded
+        if max_size is not None and len(result) > max_size:
+            raise ContentTooLargeError(f"decompressed content exceeds {max_size} bytes")
+        data = decompressor.unconsumed_tail
+    result += decompressor.flush()
+    if max_size is not None and len(result) > max_size:
+        raise ContentTooLargeError(f"decompressed content exceeds {max_size} bytes")
+    return result
+
+
+def _read(response: HTTPResponse, url_str: str, max_size: Optional[int]) -> bytes:
+    if remaining_time() is None:
+        return response.read() if max_size is None else response.read(max_size + 1)
+    chunks = []
+    size = 0
+    while max_size is None or size <= max_size:
+        _check_deadline(url_str)
+        chunk = response.read(DEADLINE_READ_SIZE if max_size is None else min(DEADLINE_READ_SIZE, max_size + 1 - size))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+    return b''.join(chunks)
 
 
 def url_get_content(url: Union[str, Request, HTTPResponse],
                     headers: Dict[str, str] = None,
                     retry: int = 5,
+                    policy: RetryPolicy = None,
+                    max_size: Optional[int] = None,
                     **kwargs) -> Union[bytes, str]:
-    Log.d(TAG, f"get content, url={url}, headers={headers}, retry={retry}, kwargs={kwargs}")
-    
+    Log.d(TAG, 'get content', url=url, headers=headers, retry=retry, max_size=max_size, kwargs=kwargs)
+    policy = policy or RetryPolicy(retry)
+
     if isinstance(url, HTTPResponse):
         response = url
         url_str = response.geturl()
     else:
-        response = urlopen_with_retry(url, headers, retry, **kwargs)
+        response = urlopen_with_retry(url, headers, policy=policy, **kwargs)
         url_str = url if isinstance(url, str) else url.full_url
+    host = urllib.parse.urlsplit(url_str).netloc
 
-    data = None
-    for i in range(1, retry + 1):
+    # reopening after a failed read is a single attempt, both share the retries of the policy
+    attempt = 0
+    while True:
+        attempt += 1
         try:
-            data = response.read()
+            if response is None:
+                policy.wait(host)
+                response = _urlopen_within_deadline(Request(url_str, headers=headers or {}), **kwargs)
+            data = _read(response, url_str, max_size)
             break
         except Exception as e:
-            Log.w(TAG, f"read response attempt {i} error: {e}")
-            if i == retry:
+            Log.w(TAG, f"read response attempt {attempt} error: {e}")
+            response = None
+            if not policy.failure(host, attempt, e):
                 raise e
-            response = urlopen_with_retry(url_str, headers, 1, **kwargs)
+    policy.success(host)
+
+    if max_size is not None and len(data) > max_size:
+        response.close()
+        raise ContentTooLargeError(f"content exceeds {max_size} bytes: {url_str}")
 
     content_encoding = response.headers.get('Content-Encoding')
     if content_encoding == 'gzip':
-        data = zlib.decompress(data, zlib.MAX_WBITS | 16)
+        data = _decompress(data, zlib.MAX_WBITS | 16, max_size)
     elif content_encoding == 'deflate':
         try:
-            data = zlib.decompress(data)
+            data = _decompress(data, zlib.MAX_WBITS, max_size)
         except zlib.error:
             Log.w(TAG, 'cannot decompress, treat as deflate data')
-            data = zlib.decompress(data, -zlib.MAX_WBITS)
+            data = _decompress(data, -zlib.MAX_WBITS, max_size)
     elif content_encoding:
         raise NotImplementedError(f"unknown encoding: {content_encoding}")
 
@@ -89,7 +478,7 @@ def url_get_content(url: Union[str, Request, HTTPResponse],
         match = re.search(r'charset=([\w-]+)', content_type)
         if match:
             charset = match.group(1)
-            Log.d(TAG, f"charset={charset}")
+            Log.d(TAG, 'charset detected', charset=charset)
     
     return data.decode(charset) if charset else data.decode('utf-8', 'ignore')
 
@@ -98,7 +487,7 @@ def url_save_guess_file(url: Union[str, Request],
                         headers: Dict[str, str] = None,
                         retry: int = 5,
                         **kwargs) -> Tuple[str, Optional[int]]:
-    Log.d(TAG, f"guess file, url={url}, headers={headers}, retry={retry}, kwargs={kwargs}")
+    Log.d(TAG, 'guess file', url=url, headers=headers, retry=retry, kwargs=kwargs)
     name, size = None, None
     with urlopen_with_retry(url, headers, retry, **kwargs) as response:
         if response.headers.get('Content-Disposition'):
@@ -118,7 +507,7 @@ def url_save_guess_file(url: Union[str, Request],
         if response.headers.get('Content-Length'):
             size = int(response.headers['Content-Length'])
             
-    Log.d(TAG, f"guess file, name={name}, size={size}")
+    Log.d(TAG, 'guess file', name=name, size=size)
     return name, size
 
 
@@ -128,7 +517,8 @@ def url_save(url: Union[str, Request],
              force: bool = False,
              reporthook=None,
              **kwargs) -> Tuple[str, int]:
-    Log.d(TAG, f"url save, url={url}, headers={headers}, filename={filename}, force={force}, reporthook={reporthook}, kwargs={kwargs}")
+    Log.d(TAG, 'url save', url=url, headers=headers, filename=filename, force=force, reporthook=reporthook,
+          kwargs=kwargs)
     
     if isinstance(url, str):
         url = Request(url)
@@ -217,5 +607,5 @@ def url_save(url: Union[str, Request],
             os.remove(filename)
         os.rename(part_file, filename)
         
-    Log.d(TAG, f"url save completed, file={filename}, size={part_size}")
+    Log.d(TAG, 'url save completed', file=filename, size=part_size)
     return filename, part_size
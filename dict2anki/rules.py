@@ -0,0 +1,238 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional, Any, Tuple
+
+from . import htmls
+from .cache import DEFAULT_CACHE_DIR
+from .utils import valid_path, get_tag, Log
+
+__all__ = [
+    'RuleError', 'Program', 'compile_rules', 'load_rules',
+]
+
+TAG = get_tag(__name__)
+
+# bump when the compiled format changes, invalidates disk caches
+COMPILER_VERSION = 3
+
+# op -> (required keys, optional keys)
+OPS = {
+    'find': (('input', 'output', 'element'), ('required',)),
+    'search': (('input', 'output', 'pattern'), ()),
+    'collect': (('input', 'output', 'element', 'pattern'), ()),
+    'append': (('input', 'output', 'format'), ()),
+    'replace': (('input', 'pattern', 'repl'), ('output',)),
+    'remove': (('input', 'elements'), ('output',)),
+    'unwrap': (('input', 'elements'), ('output',)),
+    'wrap': (('input', 'element', 'format'), ('output', 'header', 'min_length')),
+}
+
+COMMON_KEYS = ('op', 'when', 'unless')
+
+_programs: Dict[str, 'Program'] = {}
+
+# variables are views (text, start, end) into a string, so that finding an element copies nothing and
+# strings are only built by steps that change them
+_View = Tuple[str, int, int]
+
+
+def _view(text: str) -> _View:
+    return text, 0, len(text)
+
+
+def _text(view: _View) -> str:
+    text, start, end = view
+    return text if start == 0 and end == len(text) else text[start:end]
+
+
+def _empty(view: Any) -> bool:
+    # collected links are lists
+    return not view or isinstance(view, tuple) and view[1] >= view[2]
+
+
+class RuleError(Exception):
+    pass
+
+
+def _element(value: Any) -> List[str]:
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list) or not 1 <= len(value) <= 2 or not all(isinstance(v, str) for v in value):
+        raise RuleError(f"element must be [tag, attrib]: {value}")
+    return [value[0], value[1] if len(value) > 1 else '']
+
+
+# validates rules and turns them into a normalized program, kept JSON-serializable for the disk cache
+def compile_rules(rules: Dict[str, Any]) -> Dict[str, Any]:
+    steps = []
+    for i, step in enumerate(rules.get('steps', [])):
+        op = step.get('op')
+        if op not in OPS:
+            raise RuleError(f"step {i}: unknown op: {op}")
+        required, optional = OPS[op]
+        missing = [k for k in required if k not in step]
+        if missing:
+            raise RuleError(f"step {i}: missing {', '.join(missing)}")
+        unknown = [k for k in step if k not in required + optional + COMMON_KEYS]
+        if unknown:
+            raise RuleError(f"step {i}: unknown {', '.join(unknown)}")
+        step = dict(step)
+        step.setdefault('output', step['input'])
+        if 'element' in step:
+            step['element'] = _element(step['element'])
+        if 'elements' in step:
+            step['elements'] = [_element(e) for e in step['elements']]
+        if 'header' in step:
+            step['header'] = [_element(e) for e in step['header']]
+        if 'pattern' in step:
+            try:
+                re.compile(step['pattern'])
+            except re.error as e:
+                raise RuleError(f"step {i}: bad pattern: {e}") from e
+
+        # removals and unwraps are run as a single strip, consecutive ones on the same variable are fused
+        if op in ('remove', 'unwrap'):
+            elements = step.pop('elements')
+            step['op'] = 'strip'
+            step['remove'] = elements if op == 'remove' else []
+            step['unwrap'] = elements if op == 'unwrap' else []
+            last = steps[-1] if steps else None
+            if (last and last['op'] == 'strip' and last['input'] == last['output'] == step['input'] == step['output']
+                    and not any(k in s for s in (last, step) for k in COMMON_KEYS[1:])):
+                last['remove'].extend(step['remove'])
+                last['unwrap'].extend(step['unwrap'])
+                continue
+        steps.append(step)
+
+    fields = rules.get('fields')
+    if not fields or not all(isinstance(f, str) for f in fields):
+        raise RuleError('fields must be a list of variable names')
+    return {
+        'version': COMPILER_VERSION,
+        'name': rules.get('name', ''),
+        'url': rules.get('url'),
+        'actual': rules.get('actual', 'word'),
+        'links': rules.get('links'),
+        'steps': steps,
+        'fields': fields,
+    }
+
+
+class Program:
+    def __init__(self, compiled: Dict[str, Any]):
+        self.name: str = compiled['name']
+        self.url: Optional[str] = compiled['url']
+        self.actual: str = compiled['actual']
+        # variable collecting links to related words
+        self.links: Optional[str] = compiled['links']
+        self.fields: List[str] = compiled['fields']
+        self._steps = [self._prepare(step) for step in compiled['steps']]
+
+    @staticmethod
+    def _prepare(step: Dict[str, Any]) -> Dict[str, Any]:
+        step = dict(step)
+        if 'element' in step:
+            step['element'] = htmls.matcher(*step['element'])
+        if step['op'] == 'strip':
+            step['remove'] = [htmls.matcher(*e) for e in step['remove']]
+            step['unwrap'] = [htmls.matcher(*e) for e in step['unwrap']]
+        if 'header' in step:
+            step['header'] = [htmls.matcher(*e) for e in step['header']]
+        if 'pattern' in step:
+            step['pattern'] = re.compile(step['pattern'])
+        return step
+
+    @staticmethod
+    def _find(view: Optional[_View], m: htmls.Matcher) -> Optional[_View]:
+        if not view:
+            return None
+        text, start, end = view
+        for i, j in m.positions(text, pos=start, endpos=end):
+            return text, i, j
+        return None
+
+    def run(self, page: str, links: Optional[List[str]] = None) -> List[str]:
+        env: Dict[str, Any] = {'page': _view(page)}
+        for step in self._steps:
+            if 'when' in step and _empty(env.get(step['when'])):
+                continue
+            if 'unless' in step and not _empty(env.get(step['unless'])):
+                continue
+            op, value = step['op'], env.get(step['input'])
+
+            if op == 'find':
+                value = self._find(value, step['element'])
+                if value is None and step.get('required'):
+                    raise RuleError(f"can't find {step['element']} in {step['input']}")
+            elif op == 'search':
+                m = step['pattern'].search(*value) if value else None
+                value = _view(m.group(1) if m.re.groups else m.group(0)) if m else None
+            elif op == 'collect':
+                text, start, end = value or _view('')
+                value = [link for i, j in step['element'].positions(text, pos=start, endpos=end)
+                         for link in step['pattern'].findall(text, i, j)]
+            elif op == 'append':
+                if _empty(value):
+                    continue
+                output = env.get(step['output'])
+                value = _view((_text(output) if output else '') + step['format'].format(_text(value)))
+            elif value is None:
+                continue
+            elif op == 'replace':
+                value = _view(step['pattern'].sub(step['repl'], _text(value)))
+            elif op == 'strip':
+                text, start, end = value
+                value = _view(htmls.strip_many(text, step['remove'], step['unwrap'], start, end))
+            elif op == 'wrap':
+                text, start, end = value
+                if end - start > step.get('min_length', -1):
+                    value = _view(step['element'].sub(text, lambda h: self._wrap(step, h), start, end))
+            env[step['output']] = value
+
+        if links is not None and self.links:
+            links.extend(env.get(self.links) or [])
+        return [_text(env[f]) if env.get(f) else '' for f in self.fields]
+
+    def _wrap(self, step: Dict[str, Any], h: str) -> str:
+        header = _view(h)
+        for m in step.get('header', []):
+            header = self._find(header, m)
+        return step['format'].format(header=_text(header) if header else '', element=h)
+
+
+def load_rules(path: str, cache_dir: Optional[str] = DEFAULT_CACHE_DIR) -> Program:
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    digest = hashlib.sha256(data + f"/{COMPILER_VERSION}".encode('utf8')).hexdigest()
+    program = _programs.get(digest)
+    if program:
+        return program
+
+    compiled = None
+    cache_file = os.path.join(cache_dir, f"rules-{digest}.json") if cache_dir else None
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, encoding='utf8') as fp:
+                compiled = json.load(fp)
+            Log.d(TAG, 'compiled rules loaded from cache', path=path, cache=cache_file)
+        except (OSError, ValueError) as e:
+            Log.w(TAG, f"can't read compiled rules cache: {cache_file}, {e}")
+
+    if compiled is None:
+        try:
+            rules = json.loads(data.decode('utf8'))
+        except ValueError as e:
+            raise RuleError(f"can't parse rules: {path}, {e}") from e
+        compiled = compile_rules(rules)
+        Log.d(TAG, 'rules compiled', path=path, steps=len(compiled['steps']))
+        if cache_file:
+            try:
+                with open(valid_path(cache_file), 'w', encoding='utf8') as fp:
+                    json.dump(compiled, fp, ensure_ascii=False)
+            except OSError as e:
+                Log.w(TAG, f"can't write compiled rules cache: {cache_file}, {e}")
+
+    program = _programs[digest] = Program(compiled)
+    return program
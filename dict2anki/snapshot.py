@@ -0,0 +1,128 @@
+import json
+import mmap
+import struct
+import threading
+import zipfile
+import zlib
+from typing import Dict, Tuple, Optional, List
+
+from .utils import valid_path, get_tag, Log
+
+__all__ = [
+    'normalize_word', 'Snapshot', 'SnapshotWriter',
+]
+
+TAG = get_tag(__name__)
+
+INDEX_FILE = 'index.json'
+PAGES_FOLDER = 'pages'
+ASSETS_FOLDER = 'assets'
+
+# signature, version, flags, method, time, date, crc, sizes, name length, extra length
+_LOCAL_HEADER = struct.Struct('<4s5HL2L2H')
+
+
+def normalize_word(word: str) -> str:
+    return ' '.join(word.split())
+
+
+# A snapshot is a zip archive of raw pages plus an index: word -> actual word -> page
+class Snapshot:
+    def __init__(self, path: str):
+        self.path = path
+        with zipfile.ZipFile(path) as zf:
+            self._entries: Dict[str, zipfile.ZipInfo] = {info.filename: info for info in zf.infolist()}
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        index = json.loads(self._read(INDEX_FILE).decode('utf8'))
+        self._words: Dict[str, str] = index['words']
+        self._pages: Dict[str, str] = index['pages']
+        self._assets: List[str] = index.get('assets', [])
+        Log.d(TAG, f"snapshot loaded: {path}, {len(self._words)} words, {len(self._pages)} pages")
+
+    # random access straight from the mapped archive, no seeking or locking needed
+    def _read(self, name: str) -> bytes:
+        info = self._entries[name]
+        header = _LOCAL_HEADER.unpack_from(self._mmap, info.header_offset)
+        start = info.header_offset + _LOCAL_HEADER.size + header[-2] + header[-1]
+        data = self._mmap[start:start + info.compress_size]
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        if info.compress_type == zipfile.ZIP_STORED:
+            return data
+        raise NotImplementedError(f"unsupported compression: {info.compress_type}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # sent to worker processes by path, each one maps the archive again
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self._words)
+
+    def __contains__(self, word: str):
+        return normalize_word(word) in self._words
+
+    def get(self, word: str) -> Optional[Tuple[str, str]]:
+        actual = self._words.get(normalize_word(word))
+        if actual is None:
+            return None
+        return actual, self._read(self._pages[actual]).decode('utf8')
+
+    def asset_names(self) -> List[str]:
+        return list(self._assets)
+
+    def get_asset(self, name: str) -> Optional[bytes]:
+        if name not in self._assets:
+            return None
+        return self._read(f"{ASSETS_FOLDER}/{name}")
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class SnapshotWriter:
+    def __init__(self, path: str):
+        self.path = valid_path(path)
+        self._zip = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED)
+        self._lock = threading.Lock()
+        self._words: Dict[str, str] = {}
+        self._pages: Dict[str, str] = {}
+        self._assets: List[str] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, word: str, actual: str, content: str):
+        with self._lock:
+            self._words[normalize_word(word)] = actual
+            self._words.setdefault(normalize_word(actual), actual)
+            if actual in self._pages:
+                return
+            name = f"{PAGES_FOLDER}/{len(self._pages)}.html"
+            self._pages[actual] = name
+            self._zip.writestr(name, content.encode('utf8'))
+
+    def add_asset(self, name: str, data: bytes):
+        with self._lock:
+            if name not in self._assets:
+                self._assets.append(name)
+                self._zip.writestr(f"{ASSETS_FOLDER}/{name}", data)
+
+    def close(self):
+        index = {'words': self._words, 'pages': self._pages, 'assets': self._assets}
+        self._zip.writestr(INDEX_FILE, json.dumps(index, ensure_ascii=False))
+        self._zip.close()
+        Log.d(TAG, f"snapshot saved: {self.path}, {len(self._words)} words, {len(self._pages)} pages")
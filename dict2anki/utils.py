@@ -1,7 +1,10 @@
+import json
 import os
 import re
 import sys
-from typing import Callable, Optional
+import threading
+import time
+from typing import Callable, Optional, TextIO
 
 __all__ = [
     'Log',
@@ -25,6 +28,11 @@ class Log:
 
     level = INFO
 
+    # formatted arguments longer than this are truncated, None to disable
+    max_arg_length: Optional[int] = 512
+
+    _NAMES = {DEBUG: 'D', INFO: 'I', WARN: 'W', ERROR: 'E'}
+
     _TERM = os.getenv('TERM', '')
     _ANSI_TERMINAL = _TERM.startswith('xterm') or _TERM in ('eterm-color', 'linux', 'screen', 'vt100')
 
@@ -33,6 +41,29 @@ class Log:
     _GREEN = '32'
     _YELLOW = '33'
 
+    _file: Optional[TextIO] = None
+    _file_level = INFO
+    _file_lock = threading.Lock()
+
+    @staticmethod
+    def open_file(path: str, level: int = INFO):
+        # write logs of at least level to path as JSON lines, in addition to stderr; the file is buffered,
+        # only warnings and errors are flushed right away
+        Log.close_file()
+        Log._file = open(valid_path(path), 'a', encoding='utf8')
+        Log._file_level = level
+
+    @staticmethod
+    def close_file():
+        with Log._file_lock:
+            if Log._file:
+                Log._file.close()
+                Log._file = None
+
+    @staticmethod
+    def enabled(level: int) -> bool:
+        return Log.level <= level or (Log._file is not None and Log._file_level <= level)
+
     @staticmethod
     def _colorize(msg: str, *colors: str) -> str:
         if Log._ANSI_TERMINAL:
@@ -44,28 +75,56 @@ class Log:
         sys.stderr.write(Log._colorize(f"{msg}\n", *colors))
 
     @staticmethod
-    def d(tag: str, msg: str):
-        if Log.level <= Log.DEBUG:
-            Log._print(f"D/{tag:<10}: {msg}")
+    def _truncate(value):
+        # numbers are passed through so that format specs still apply
+        if isinstance(value, (int, float)):
+            return value
+        value = str(value)
+        if Log.max_arg_length is not None and len(value) > Log.max_arg_length:
+            return f"{value[:Log.max_arg_length]}...({len(value)} chars)"
+        return value
 
     @staticmethod
-    def i(tag: str, msg: str):
-        if Log.level <= Log.INFO:
-            Log._print(f"I/{tag:<10}: {msg}", Log._GREEN)
+    def _log(level: int, tag: str, msg: str, args: tuple, fields: dict, *colors: str):
+        if not Log.enabled(level):
+            return
+        # arguments are only formatted when the message is actually written
+        if args:
+            msg = msg.format(*(Log._truncate(a) for a in args))
+        fields = {k: Log._truncate(v) for k, v in fields.items()}
+        if Log.level <= level:
+            extra = ''.join(f", {k}={v}" for k, v in fields.items())
+            Log._print(f"{Log._NAMES[level]}/{tag:<10}: {msg}{extra}", *colors)
+        if Log._file is not None and Log._file_level <= level:
+            record = {'time': time.time(), 'level': Log._NAMES[level], 'tag': tag, 'msg': msg}
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False) + '\n'
+            with Log._file_lock:
+                if Log._file:
+                    Log._file.write(line)
+                    if level >= Log.WARN:
+                        Log._file.flush()
 
     @staticmethod
-    def w(tag: str, msg: str):
-        if Log.level <= Log.WARN:
-            Log._print(f"W/{tag:<10}: {msg}", Log._YELLOW)
+    def d(tag: str, msg: str, *args, **fields):
+        if Log.enabled(Log.DEBUG):
+            Log._log(Log.DEBUG, tag, msg, args, fields)
 
     @staticmethod
-    def e(tag: str, msg: str):
-        if Log.level <= Log.ERROR:
-            Log._print(f"E/{tag:<10}: {msg}", Log._RED)
+    def i(tag: str, msg: str, *args, **fields):
+        Log._log(Log.INFO, tag, msg, args, fields, Log._GREEN)
+
+    @staticmethod
+    def w(tag: str, msg: str, *args, **fields):
+        Log._log(Log.WARN, tag, msg, args, fields, Log._YELLOW)
+
+    @staticmethod
+    def e(tag: str, msg: str, *args, **fields):
+        Log._log(Log.ERROR, tag, msg, args, fields, Log._RED)
 
 
 def valid_path(path: str, force: bool = True) -> str:
-    Log.d(TAG, f"valid path, path={path}, force={force}")
+    Log.d(TAG, 'valid path', path=path, force=force)
     dir_name, base_name = os.path.split(path)
     if dir_name:
         os.makedirs(dir_name, exist_ok=True)
@@ -96,18 +155,30 @@ def valid_path(path: str, force: bool = True) -> str:
         base_name = name + ext
         path = os.path.join(dir_name, base_name)
 
-    Log.d(TAG, f"valid path, path={path}")
+    Log.d(TAG, 'valid path', path=path)
     return path
 
 
 class ProgressBar:
-    def __init__(self, total: int = 100, progress: int = 0, detail: Optional[Callable[[int], str]] = None, extra: str = None):
+    # seconds between redraws on a terminal and between lines otherwise
+    TTY_INTERVAL = 0.1
+    LINE_INTERVAL = 10
+
+    def __init__(self, total: int = 100, progress: int = 0, detail: Optional[Callable[[int], str]] = None, extra: str = None,
+                 interval: Optional[float] = None, stream: Optional[TextIO] = None):
         self._total = total
         self._progress = progress
         self._detail = detail
         self._extra = extra
         self._show = False
         self._formation = '{:>5}% ├{:─<25}┤ {:>9} / {:<9}{:>23}'
+        self._stream = stream or sys.stdout
+        self._tty = self._stream.isatty() if hasattr(self._stream, 'isatty') else False
+        self._interval = interval if interval is not None else (self.TTY_INTERVAL if self._tty else self.LINE_INTERVAL)
+        self._start = time.monotonic()
+        self._last = None
+        self.in_flight = 0
+        self.errors = 0
 
     @property
     def total(self):
@@ -133,10 +204,27 @@ class ProgressBar:
 
     @extra.setter
     def extra(self, value: str):
+        # shown on the next redraw
         self._extra = value
-        self.update()
 
-    def update(self):
+    def _stats(self) -> str:
+        elapsed = time.monotonic() - self._start
+        rate = self._progress / elapsed if elapsed > 0 else 0
+        stats = f"{rate:.1f}/s"
+        if rate > 0 and self._total > self._progress:
+            eta = int((self._total - self._progress) / rate)
+            stats += f" ETA {eta // 60:02d}:{eta % 60:02d}"
+        if self.in_flight:
+            stats += f" active {self.in_flight}"
+        if self.errors:
+            stats += f" errors {self.errors} ({self.errors * 100 / max(self._progress, 1):.1f}%)"
+        return stats
+
+    def update(self, force: bool = False):
+        now = time.monotonic()
+        if not force and self._last is not None and now - self._last < self._interval:
+            return
+        self._last = now
         self._show = True
         percentage = round(self._progress * 100 / self._total, 1) if self._total > 0 else 0
         percentage = min(percentage, 100)
@@ -147,14 +235,25 @@ class ProgressBar:
         extra_str = self._extra if self._extra is not None else ''
         
         line = self._formation.format(percentage, '█' * bar_count, prog_str, total_str, extra_str)
-        sys.stdout.write('\r' + line)
-        sys.stdout.flush()
+        line += '  ' + self._stats()
+        if self._tty:
+            self._stream.write('\r' + line + '\033[K')
+        else:
+            self._stream.write(line + '\n')
+        self._stream.flush()
 
     def increment(self, n: int = 1):
         self._progress += n
         self.update()
 
+    def fail(self, n: int = 1):
+        self.errors += n
+        self.increment(n)
+
     def done(self):
         if self._show:
-            print()
+            self.update(force=True)
+            if self._tty:
+                self._stream.write('\n')
+                self._stream.flush()
             self._show = False
@@ -13,6 +13,7 @@ setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     packages=['dict2anki', 'dict2anki.extractors'],
+    package_data={'dict2anki.extractors': ['*.json']},
     entry_points={
         'console_scripts': [
             'dict2anki = dict2anki.__main__:main'
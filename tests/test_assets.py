@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from dict2anki.assets import *
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+
+class TestAssets(TestCase):
+    CSS = '''/* comment */
+@charset "utf-8";
+@font-face { font-family: "icons"; src: url(_icons.woff) format("woff"); }
+.card { color: black; }
+.def, .unused { margin : 0 ; }
+div.def > span#title:hover::before { content: "a , b"; }
+.i-amphtml-element { display: block; }
+.unused .def { color: red; }
+@media (max-width: 600px) {
+    .def { padding: 0; }
+    .unused { padding: 1px; }
+}
+@media print { .unused { display: none; } }
+.bg { background: url(data:image/svg+xml;base64,AAAA); }
+'''
+
+    HTML = '<div class="def bg"><span id="title">title</span></div>'
+
+    def test_collect_selectors(self):
+        self.assertEqual({'div', 'span', '.def', '.bg', '#title'}, collect_selectors([self.HTML]))
+
+    def test_prune_css(self):
+        css = prune_css(self.CSS, collect_selectors([self.HTML]), ('i-amphtml',))
+        Log.d(TAG, css)
+        self.assertNotIn('unused', css)
+        self.assertNotIn('@media print', css)
+        for s in ('@charset', '@font-face', '.card', '.def', 'span#title:hover::before', '.i-amphtml-element',
+                  '@media (max-width: 600px)', 'base64,AAAA'):
+            self.assertIn(s, css)
+
+    def test_minify_css(self):
+        css = minify_css(self.CSS)
+        Log.d(TAG, css)
+        self.assertNotIn('comment', css)
+        self.assertIn('.def,.unused{margin : 0}', css)
+        self.assertIn('content: "a , b"', css)
+        self.assertIn('url(data:image/svg+xml;base64,AAAA)', css)
+
+    def test_optimize_styling(self):
+        styling = f"<style>{self.CSS}</style>\n<script>var a = 1;</script>\n<script>var b = 2;</script>\n"
+        styling, scripts = optimize_styling(styling, collect_selectors([self.HTML]))
+        self.assertTrue(styling.startswith('<style>') and styling.endswith('</style>\n'))
+        self.assertNotIn('<script', styling)
+        self.assertEqual(['var a = 1;', 'var b = 2;'], [s for _, s in scripts])
+        for name, _ in scripts:
+            self.assertRegex(name, r'^_script-[0-9a-f]{8}\.js$')
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from dict2anki.cache import *
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+
+class TestNegativeCache(TestCase):
+    def test_negative_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache', 'missing.json')
+            cache = NegativeCache(path)
+            cache.add('Typo  Word')
+            self.assertIn('typo word', cache)
+            self.assertNotIn('word', cache)
+            cache.save()
+
+            cache = NegativeCache(path)
+            self.assertIn('typo word', cache)
+            cache.discard('typo word')
+            self.assertNotIn('typo word', cache)
+            cache.save()
+            self.assertEqual(0, len(NegativeCache(path)))
+
+    def test_ttl(self):
+        cache = NegativeCache(ttl=0.1)
+        cache.add('typo')
+        self.assertIn('typo', cache)
+        time.sleep(0.2)
+        self.assertNotIn('typo', cache)
+
+    def test_bad_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'missing.json')
+            with open(path, 'w') as fp:
+                fp.write('[')
+            self.assertEqual(0, len(NegativeCache(path)))
@@ -0,0 +1,62 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from dict2anki import cards
+from dict2anki.cards import *
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+CARDS = [
+    ['word', '<div class="def">a "unit"\tof\nlanguage</div>'],
+    ['"quoted"', 'back, with comma'],
+]
+
+
+class TestCards(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_csv(self):
+        path = os.path.join(self.tmp.name, 'cards.txt')
+        self.assertEqual(2, write_cards(path, CARDS))
+        write_cards(path, CARDS[:1])
+        self.assertEqual(CARDS + CARDS[:1], read_cards(path))
+
+    def test_tsv(self):
+        path = os.path.join(self.tmp.name, 'cards.txt')
+        write_cards(path, CARDS, FORMAT_TSV)
+        write_cards(path, CARDS[:1], FORMAT_TSV)
+        with open(path, encoding='utf8') as fp:
+            content = fp.read()
+        # header written once, quotes inside html are not escaped
+        self.assertTrue(content.startswith(cards.TSV_HEADER))
+        self.assertEqual(1, content.count(cards.TSV_HEADER))
+        self.assertIn('<div class="def">a "unit" of language</div>', content)
+        self.assertEqual([['word', '<div class="def">a "unit" of language</div>'], CARDS[1]] + [
+            ['word', '<div class="def">a "unit" of language</div>']], read_cards(path))
+
+    def test_gzip(self):
+        path = os.path.join(self.tmp.name, 'cards.txt.gz')
+        write_cards(path, CARDS, FORMAT_TSV, compress=True)
+        write_cards(path, CARDS[1:], FORMAT_TSV, compress=True)
+        self.assertEqual(3, len(read_cards(path)))
+        self.assertEqual(CARDS[1], read_cards(path)[-1])
+
+    def test_buffer(self):
+        path = os.path.join(self.tmp.name, 'cards.txt')
+        size, cards.BUFFER_SIZE = cards.BUFFER_SIZE, 16
+        try:
+            write_cards(path, CARDS * 10, FORMAT_TSV)
+        finally:
+            cards.BUFFER_SIZE = size
+        self.assertEqual(20, len(read_cards(path)))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, write_cards, os.path.join(self.tmp.name, 'cards.txt'), CARDS, 'xml')
@@ -0,0 +1,301 @@
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+
+from dict2anki.cache import NegativeCache
+from dict2anki.extractors import extractor
+from dict2anki.extractors import CambridgeExtractor, ExtractError, RuleExtractor, WordNotFoundError
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+
+class _TempTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.out_path = os.path.join(self.tmp.name, 'out')
+        # compiled rules are cached here instead of the user cache
+        self.rules_cache_dir = os.path.join(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+class _PageExtractor(CambridgeExtractor):
+    def __init__(self, out_path: str, page: str, **kwargs):
+        super().__init__(out_path, **kwargs)
+        self.page = page
+
+    def _fetch(self, word):
+        return word, self.page
+
+
+class TestLargePage(_TempTestCase):
+    BLOCK = '<div class="def-block ddef_block"><div class="def-body ddef_b">' \
+            '<span class="trans dtrans dtrans-se">释义</span><a class="query" href="/q">query</a> ' \
+            '<span class="x-h dx-h">highlight</span>' + 'lorem ipsum ' * 80 + '</div>' \
+            '<div class="xref r">related</div><script>ad()</script></div>'
+
+    @classmethod
+    def setUpClass(cls):
+        # a synthetic 10MB page
+        cls.page = '<html><body><div class="di-body"><div class="di-title"><span>word</span></div>' + \
+                   cls.BLOCK * (10 * 1024 * 1024 // len(cls.BLOCK)) + '</div></body></html>'
+
+    def test_extract(self):
+        extractor = _PageExtractor(self.out_path, self.page, rules_cache_dir=self.rules_cache_dir)
+        level, Log.level = Log.level, Log.INFO
+        tracemalloc.start()
+        try:
+            _, (front, back) = extractor.get_card('word')
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            Log.level = level
+        Log.d(TAG, 'peak memory: {:.2f} pages', peak / sys.getsizeof(self.page))
+        self.assertLess(peak, 4 * sys.getsizeof(self.page))
+        self.assertEqual(self.page.count('def-block ddef_block'), back.count('<amp-accordion>'))
+        self.assertNotIn('xref', back)
+        self.assertNotIn('<a ', back)
+        self.assertNotIn('<script>', back)
+
+    def test_max_page_size(self):
+        extractor = _PageExtractor(self.out_path, self.page, max_page_size=1024 * 1024,
+                                   rules_cache_dir=self.rules_cache_dir)
+        self.assertRaises(ExtractError, extractor.get_card, 'word')
+
+
+class _LinkedExtractor(CambridgeExtractor):
+    PAGE = '<div class="di-body"><div class="di-title"><span>{}</span></div>' \
+           '<div class="xref"><a href="/dictionary/english/{}">related</a></div></div>'
+
+    def __init__(self, out_path: str, links, **kwargs):
+        super().__init__(out_path, **kwargs)
+        self.links = links
+        self.fetched = []
+        # words fetched by the prefetcher
+        self.prefetched = []
+        self.lock = threading.Lock()
+
+    def _fetch(self, word):
+        with self.lock:
+            self.fetched.append(word)
+            if threading.current_thread().name.startswith('prefetch'):
+                self.prefetched.append(word)
+        return word, self.PAGE.format(word, self.links.get(word, 'none'))
+
+
+class TestPrefetch(_TempTestCase):
+    LINKS = {'word 0': 'word-9', 'word 1': 'word-8', 'word 2': 'not-listed'}
+    WORDS = tuple(f"word {i}" for i in range(10))
+
+    def test_prefetch(self):
+        # words are looked up in order, the related ones at the end are prefetched long before
+        extractor = _LinkedExtractor(self.out_path, self.LINKS, prefetch=True, concurrency=1,
+                                     rules_cache_dir=self.rules_cache_dir)
+        extractor.generate_cards(*self.WORDS)
+        # every word is fetched once, related words not in the list are never fetched
+        self.assertCountEqual(self.WORDS, extractor.fetched)
+        self.assertCountEqual(['word 9', 'word 8'], extractor.prefetched)
+        self.assertEqual(len(self.WORDS), len(extractor._read_cards()))
+
+    def test_prefetch_max_pages(self):
+        max_pages, extractor.PREFETCH_MAX_PAGES = extractor.PREFETCH_MAX_PAGES, 1
+        try:
+            instance = _LinkedExtractor(self.out_path, self.LINKS, prefetch=True, concurrency=1,
+                                        rules_cache_dir=self.rules_cache_dir)
+            instance.generate_cards(*self.WORDS)
+        finally:
+            extractor.PREFETCH_MAX_PAGES = max_pages
+        # the page of word 9 is held until its turn, word 8 isn't prefetched meanwhile
+        self.assertEqual(['word 9'], instance.prefetched)
+        self.assertCountEqual(self.WORDS, instance.fetched)
+        self.assertEqual(len(self.WORDS), len(instance._read_cards()))
+
+    def test_prefetch_failed(self):
+        class Extractor(_LinkedExtractor):
+            def _fetch(self, word):
+                result = super()._fetch(word)
+                if threading.current_thread().name.startswith('prefetch'):
+                    raise OSError('connection reset')
+                return result
+
+        extractor = Extractor(self.out_path, self.LINKS, prefetch=True, concurrency=1,
+                              rules_cache_dir=self.rules_cache_dir)
+        extractor.generate_cards(*self.WORDS)
+        # failed prefetches are looked up again
+        self.assertCountEqual(['word 9', 'word 8'], extractor.prefetched)
+        self.assertEqual(2, extractor.fetched.count('word 9'))
+        self.assertEqual(len(self.WORDS), len(extractor._read_cards()))
+
+    def test_no_prefetch(self):
+        extractor = _LinkedExtractor(self.out_path, self.LINKS, rules_cache_dir=self.rules_cache_dir)
+        extractor.generate_cards(*self.WORDS)
+        self.assertCountEqual(self.WORDS, extractor.fetched)
+
+
+# pickled to worker processes
+class _MissingExtractor(CambridgeExtractor):
+    def _fetch(self, word):
+        if word == 'missing':
+            raise WordNotFoundError(f"not found: \"{word}\"")
+        return word, _LinkedExtractor.PAGE.format(word, 'none')
+
+
+class TestNegativeCache(_TempTestCase):
+    def test_process_backend(self):
+        cache = NegativeCache()
+        cache.add('word 1')
+        instance = _MissingExtractor(self.out_path, negative_cache=cache, backend='process', workers=1,
+                                     rules_cache_dir=self.rules_cache_dir)
+        instance.generate_cards('word 0', 'word 1', 'missing')
+        # workers have no cache, it's checked and updated by the main process
+        cards = instance._read_cards()
+        self.assertEqual(1, len(cards))
+        self.assertIn('word 0', cards[0][0])
+        self.assertIn('missing', cache)
+
+
+class TestGenerate(_TempTestCase):
+    WORDS = ('word 0', 'word 1')
+
+    def test_generate(self):
+        fetched = threading.Event()
+
+        class Extractor(_LinkedExtractor):
+            def _retrieve_styling(self):
+                # only returns if cards are fetched at the same time
+                if not fetched.wait(10):
+                    raise TimeoutError('styling retrieved before cards')
+                return '<style></style>'
+
+            def _fetch(self, word):
+                fetched.set()
+                return super()._fetch(word)
+
+        extractor = Extractor(self.out_path, {}, rules_cache_dir=self.rules_cache_dir)
+        self.assertTrue(extractor.generate(*self.WORDS))
+        self.assertEqual('<style></style>', extractor._styling)
+        self.assertEqual(len(self.WORDS), len(extractor._read_cards()))
+        self.assertTrue(os.path.isfile(extractor.styling_file))
+
+    def test_generate_styling_failed(self):
+        class Extractor(_LinkedExtractor):
+            def _retrieve_styling(self):
+                raise OSError('offline')
+
+        extractor = Extractor(self.out_path, {}, rules_cache_dir=self.rules_cache_dir)
+        self.assertFalse(extractor.generate(*self.WORDS))
+        self.assertEqual(len(self.WORDS), len(extractor._read_cards()))
+
+
+class TestSlowWords(_TempTestCase):
+    def test_word_timeout(self):
+        class Extractor(_LinkedExtractor):
+            def _fetch(self, word):
+                if word == 'slow':
+                    time.sleep(2)
+                return super()._fetch(word)
+
+        grace, extractor.DEADLINE_GRACE = extractor.DEADLINE_GRACE, 0
+        try:
+            instance = Extractor(self.out_path, {}, word_timeout=0.2, rules_cache_dir=self.rules_cache_dir)
+            instance.generate_cards('slow', 'fast')
+        finally:
+            extractor.DEADLINE_GRACE = grace
+        cards = instance._read_cards()
+        self.assertEqual(1, len(cards))
+        self.assertIn('fast', cards[0][0])
+
+    def test_hedge(self):
+        class Extractor(_LinkedExtractor):
+            def _fetch(self, word):
+                attempt = self.fetched.count(word)
+                result = super()._fetch(word)
+                time.sleep(2 if word == 'slow' and attempt == 0 else 0.01)
+                return result
+
+        words = tuple(f"word {i}" for i in range(40)) + ('slow',)
+        instance = Extractor(self.out_path, {}, hedge=True, rules_cache_dir=self.rules_cache_dir)
+        instance.generate_cards(*words)
+        self.assertEqual(2, instance.fetched.count('slow'))
+        self.assertEqual(len(words), len(instance._read_cards()))
+
+
+class _DictHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def _respond(self):
+        _DictHandler.requests.append((self.command, self.path))
+        if self.path.startswith('/search?q='):
+            word = self.path[len('/search?q='):]
+            self.send_response(302)
+            self.send_header('Location', '/spellcheck/' if word == 'typo' else f"/dictionary/{word}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = f"<div class=\"body\"><h1>{self.path.rsplit('/', 1)[-1]}</h1></div>".encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TestValidate(_TempTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _DictHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        super().setUp()
+        _DictHandler.requests.clear()
+        self.rules = os.path.join(self.tmp.name, 'dict.json')
+        with open(self.rules, 'w', encoding='utf8') as fp:
+            json.dump({
+                'url': f"http://127.0.0.1:{self.server.server_port}/search?q={{}}",
+                'actual': 'redirect',
+                'steps': [{'op': 'find', 'input': 'page', 'output': 'title', 'element': 'h1', 'required': True}],
+                'fields': ['title', 'page'],
+            }, fp)
+
+    def test_validate(self):
+        cache = NegativeCache()
+        extractor = RuleExtractor(self.out_path, rules=self.rules, negative_cache=cache,
+                                  rules_cache_dir=self.rules_cache_dir)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            self.assertEqual(['typo'], extractor.validate('word', 'typo'))
+        # stdout is left to the report of missing words
+        self.assertEqual('', stdout.getvalue())
+        # only heads, the missing word costs one request
+        self.assertEqual({'HEAD'}, {method for method, _ in _DictHandler.requests})
+        self.assertEqual(1, sum(path == '/search?q=typo' for _, path in _DictHandler.requests))
+        self.assertIn('typo', cache)
+
+        _DictHandler.requests.clear()
+        self.assertEqual(['typo'], extractor.validate('typo'))
+        self.assertEqual([], _DictHandler.requests)
+        self.assertEqual('word', extractor.get_card('word')[0])
+        self.assertRaises(Exception, extractor.get_card, 'typo')
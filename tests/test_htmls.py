@@ -1,4 +1,6 @@
 import re
+import time
+from typing import Callable
 from unittest import TestCase
 
 from dict2anki import htmls
@@ -39,3 +41,71 @@ class TestHtml(TestCase):
 
     def test_removeall(self):
         Log.d(TAG, htmls.removeall(self.HTML, 'a'))
+
+
+class TestHtmlPerformance(TestCase):
+    # time of 4x the input over time of the input, linear is about 4 and quadratic 16
+    MAX_RATIO = 8
+
+    SIBLING = '<div class="entry"><span class="hw">word</span> <p>a <b>unit</b> of language</p></div>'
+
+    def setUp(self):
+        self.level, Log.level = Log.level, Log.INFO
+
+    def tearDown(self):
+        Log.level = self.level
+
+    @staticmethod
+    def _best_time(func: Callable[[str], object], html_str: str) -> float:
+        best = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            func(html_str)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    def _assert_linear(self, func: Callable[[str], object], make: Callable[[int], str], n: int = 10000):
+        small, large = self._best_time(func, make(n)), self._best_time(func, make(4 * n))
+        Log.i(TAG, '{}: {:.4f}s, 4x: {:.4f}s, ratio {:.1f}', func.__name__, small, large, large / small)
+        self.assertLess(large / small, self.MAX_RATIO)
+
+    def _siblings(self, n: int) -> str:
+        return '<html><body>' + self.SIBLING * n + '</body></html>'
+
+    @staticmethod
+    def _nested(n: int) -> str:
+        return '<div class="entry">' * n + 'word' + '</div>' * n
+
+    def test_find_positions_siblings(self):
+        def find_positions(html_str):
+            self.assertEqual(html_str.count('<div'), len(list(htmls.find_positions(html_str, 'div', 'class="entry"'))))
+
+        self._assert_linear(find_positions, self._siblings)
+
+    def test_find_positions_nested(self):
+        def find_positions(html_str):
+            self.assertEqual([(0, len(html_str))], list(htmls.find_positions(html_str, 'div', 'class="entry"')))
+
+        self._assert_linear(find_positions, self._nested)
+
+    def test_sub_siblings(self):
+        def sub(html_str):
+            self.assertNotIn('<b>', htmls.sub(html_str, lambda h: h[3:-4], 'b'))
+
+        self._assert_linear(sub, self._siblings)
+
+    def test_sub_nested(self):
+        def sub(html_str):
+            self.assertEqual('word', htmls.sub(html_str, lambda h: 'word', 'div'))
+
+        self._assert_linear(sub, self._nested)
+
+    def test_strip_many(self):
+        remove = [htmls.matcher('span'), htmls.matcher('p')]
+        unwrap = [htmls.matcher('div', 'class="entry"')]
+
+        def strip_many(html_str):
+            self.assertEqual('<html><body>' + ' ' * html_str.count('<div') + '</body></html>',
+                             htmls.strip_many(html_str, remove, unwrap))
+
+        self._assert_linear(strip_many, self._siblings)
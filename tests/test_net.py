@@ -1,7 +1,17 @@
+import gzip
 import hashlib
+import os
+import socket
+import ssl
+import threading
+import time
+import tracemalloc
 import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import TestCase
+from urllib.error import HTTPError, URLError
 
+from dict2anki import net
 from dict2anki.net import *
 from dict2anki.utils import Log, get_tag
 
@@ -14,6 +24,9 @@ URL_CAMBRIDGE_QUERY = 'https://dictionary.cambridge.org/zhs/%E6%90%9C%E7%B4%A2/d
 
 URL_DEBIAN_CD_PATH = 'https://cdimage.debian.org/debian-cd/current/amd64/iso-cd/{}'
 
+# a self-signed certificate for localhost and 127.0.0.1 with its key
+KEYCERT = os.path.join(os.path.dirname(__file__), 'keycert.pem')
+
 
 class TestNet(TestCase):
     def test_urlopen_with_retry(self):
@@ -48,3 +61,228 @@ class TestNet(TestCase):
                 sha256_actual.update(buffer)
                 buffer = f.read(512 * 1024)
         self.assertEqual(sha256, sha256_actual.hexdigest())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    hits = {}
+
+    def do_GET(self):
+        _Handler.hits[self.path] = _Handler.hits.get(self.path, 0) + 1
+        if self.path == '/missing':
+            self.send_error(404)
+        elif self.path == '/slow':
+            time.sleep(2)
+            self.send_error(404)
+        elif self.path == '/flaky':
+            if _Handler.hits[self.path] == 1:
+                # a truncated body, later requests fail
+                self.send_response(200)
+                self.send_header('Content-Length', '100')
+                self.end_headers()
+                self.wfile.write(b'ok')
+            else:
+                self.send_error(503)
+        elif self.path == '/down':
+            self.send_error(503)
+        elif self.path == '/unavailable':
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+        else:
+            body = b'ok'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        _Handler.hits['HEAD ' + self.path] = _Handler.hits.get('HEAD ' + self.path, 0) + 1
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _TlsHandler(_Handler):
+    reused = []
+
+    def handle_one_request(self):
+        _TlsHandler.reused.append(self.request.session_reused)
+        super().handle_one_request()
+
+
+class _LocalServerTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        _Handler.hits.clear()
+
+
+class TestRetryPolicy(_LocalServerTestCase):
+    def test_permanent_error(self):
+        with self.assertRaises(HTTPError) as cm:
+            urlopen_with_retry(self.url + '/missing', policy=RetryPolicy(breaker=None))
+        self.assertEqual(404, cm.exception.code)
+        self.assertEqual(1, _Handler.hits['/missing'])
+
+    def test_transient_error(self):
+        policy = RetryPolicy(retry=3, backoff=0, breaker=None)
+        self.assertRaises(HTTPError, urlopen_with_retry, self.url + '/unavailable', policy=policy)
+        self.assertEqual(3, _Handler.hits['/unavailable'])
+        self.assertEqual('ok', url_get_content(self.url + '/ok', policy=policy))
+
+    def test_read_retry(self):
+        # reopening after a failed read takes one attempt of the same budget
+        policy = RetryPolicy(retry=3, backoff=0, breaker=None)
+        self.assertRaises(HTTPError, url_get_content, self.url + '/flaky', policy=policy)
+        self.assertEqual(3, _Handler.hits['/flaky'])
+
+    def test_retry_after(self):
+        policy = RetryPolicy(max_retry_after=5)
+        e = HTTPError('', 503, '', {'Retry-After': '120'}, None)
+        self.assertEqual(5, policy.delay(1, e))
+        self.assertTrue(policy.is_transient(e))
+        self.assertFalse(policy.is_transient(HTTPError('', 410, '', {}, None)))
+        self.assertTrue(policy.is_transient(socket.timeout()))
+        self.assertTrue(policy.is_transient(URLError(ConnectionRefusedError())))
+        self.assertTrue(policy.is_transient(URLError(socket.gaierror())))
+        self.assertFalse(policy.is_transient(URLError(ssl.SSLCertVerificationError())))
+        self.assertFalse(policy.is_transient(URLError('unknown url type: ftps')))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.5)
+        policy = RetryPolicy(retry=2, backoff=0, breaker=breaker)
+        host = f"127.0.0.1:{self.server.server_port}"
+        self.assertRaises(HTTPError, urlopen_with_retry, self.url + '/unavailable', policy=policy)
+        self.assertTrue(breaker.is_open(host))
+        start = time.monotonic()
+        with urlopen_with_retry(self.url + '/ok', policy=policy) as response:
+            self.assertEqual(200, response.status)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertFalse(breaker.is_open(host))
+
+
+class TestDeadline(_LocalServerTestCase):
+    def test_deadline(self):
+        start = time.monotonic()
+        with deadline(0.3):
+            self.assertRaises(OSError, url_get_content, self.url + '/slow', policy=RetryPolicy(breaker=None))
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertIsNone(remaining_time())
+
+    def test_deadline_retry(self):
+        policy = RetryPolicy(retry=100, backoff=0.1, factor=1, breaker=None)
+        start = time.monotonic()
+        with deadline(0.5):
+            self.assertRaises((HTTPError, DeadlineExceededError), urlopen_with_retry, self.url + '/down',
+                              policy=policy)
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertLess(_Handler.hits['/down'], 100)
+        with deadline(0):
+            self.assertRaises(DeadlineExceededError, urlopen_with_retry, self.url + '/ok', policy=policy)
+
+
+class TestConnections(_LocalServerTestCase):
+    def test_dns_cache(self):
+        cache = DnsCache()
+        addresses = cache.resolve('localhost', 80)
+        self.assertIs(addresses, cache.resolve('localhost', 80))
+        cache.invalidate('localhost', 80)
+        self.assertIsNot(addresses, cache.resolve('localhost', 80))
+        cache = DnsCache(ttl=0)
+        addresses = cache.resolve('localhost', 80)
+        self.assertIsNot(addresses, cache.resolve('localhost', 80))
+
+    def test_tls_session_cache(self):
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(KEYCERT)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _TlsHandler)
+        server.socket = server_context.wrap_socket(server.socket, server_side=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        opener, net._opener = net._opener, net._build_opener(ssl.create_default_context(cafile=KEYCERT))
+        try:
+            url = f"https://127.0.0.1:{server.server_port}/"
+            warm_up([url], timeout=5)
+            # the server closes connections, the session is resumed by a new one
+            self.assertEqual('ok', url_get_content(url + 'ok', policy=RetryPolicy(breaker=None)))
+        finally:
+            net._opener = opener
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([False, True], _TlsHandler.reused)
+
+    def test_warm_up(self):
+        warm_up([self.url + '/ok', self.url + '/missing', 'http://127.0.0.1:1/'], connections=3, timeout=1)
+        self.assertEqual(3, _Handler.hits['HEAD /'])
+
+
+class _GzipHandler(BaseHTTPRequestHandler):
+    # a 16MB page, compressed to a few hundred KB
+    SIZE = 16 * 1024 * 1024
+    BODY = gzip.compress(('<div class="entry">word</div>\n' * (SIZE // 29)).encode('utf8'))
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(self.BODY)))
+        self.end_headers()
+        self.wfile.write(self.BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestNetPerformance(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _GzipHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.level, Log.level = Log.level, Log.INFO
+
+    def tearDown(self):
+        Log.level = self.level
+
+    def _peak(self, func) -> int:
+        tracemalloc.start()
+        try:
+            func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_gzip_memory(self):
+        content = []
+        peak = self._peak(lambda: content.append(url_get_content(self.url, max_size=32 * 1024 * 1024)))
+        size = len(content[0])
+        Log.i(TAG, 'peak memory: {:.2f} pages', peak / size)
+        self.assertGreater(size, _GzipHandler.SIZE - 64)
+        # the decompressed bytes and the decoded page
+        self.assertLess(peak, 2.5 * size)
+
+    def test_gzip_too_large(self):
+        max_size = 1024 * 1024
+        peak = self._peak(lambda: self.assertRaises(ContentTooLargeError, url_get_content, self.url,
+                                                    max_size=max_size))
+        Log.i(TAG, 'peak memory: {:.2f} limits', peak / max_size)
+        # inflating stops at the limit
+        self.assertLess(peak, 4 * max_size)
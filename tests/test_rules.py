@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from dict2anki import rules
+from dict2anki.rules import *
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+RULES = {
+    'name': 'test',
+    'steps': [
+        {'op': 'find', 'input': 'page', 'output': 'body', 'element': ['div', 'class="body"'], 'required': True},
+        {'op': 'find', 'input': 'body', 'output': 'title', 'element': 'h1'},
+        {'op': 'search', 'input': 'body', 'output': 'audio', 'pattern': 'src="([^"]+\\.mp3)"'},
+        {'op': 'append', 'input': 'audio', 'output': 'title', 'format': '<audio src="{}"></audio>'},
+        {'op': 'remove', 'input': 'body', 'elements': [['h1']]},
+        {'op': 'remove', 'input': 'body', 'elements': [['div', 'class="ad"'], ['script']]},
+        {'op': 'unwrap', 'input': 'body', 'elements': [['a', 'href=']]},
+        {'op': 'wrap', 'input': 'body', 'element': ['p'], 'header': ['b'], 'min_length': 10,
+         'format': '<section><header>{header}</header>{element}</section>'},
+    ],
+    'fields': ['title', 'body'],
+}
+
+PAGE = '''<html><div class="body"><h1>word</h1><source src="/word.mp3">
+<p><b>n.</b> a <a href="/x">unit</a></p><div class="ad"><div>ad</div></div><script>ad()</script></div></html>'''
+
+
+class TestRules(TestCase):
+    def test_compile_rules(self):
+        compiled = compile_rules(RULES)
+        # consecutive removals and unwraps are fused
+        self.assertEqual(6, len(compiled['steps']))
+        self.assertEqual([['h1', ''], ['div', 'class="ad"'], ['script', '']], compiled['steps'][4]['remove'])
+        self.assertEqual([['a', 'href=']], compiled['steps'][4]['unwrap'])
+        self.assertRaises(RuleError, compile_rules, {'steps': [{'op': 'nope'}], 'fields': ['a']})
+        self.assertRaises(RuleError, compile_rules, {'steps': [{'op': 'find', 'input': 'page'}], 'fields': ['a']})
+        self.assertRaises(RuleError, compile_rules, {'steps': [], 'fields': []})
+
+    def test_run(self):
+        title, body = Program(compile_rules(RULES)).run(PAGE)
+        self.assertEqual('<h1>word</h1><audio src="/word.mp3"></audio>', title)
+        self.assertNotIn('class="ad"', body)
+        self.assertNotIn('<script>', body)
+        self.assertNotIn('<a ', body)
+        self.assertIn('<section><header><b>n.</b></header><p>', body)
+        self.assertRaises(RuleError, Program(compile_rules(RULES)).run, '<html></html>')
+
+    def test_collect(self):
+        links = []
+        program = Program(compile_rules({
+            'links': 'related',
+            'steps': [{'op': 'collect', 'input': 'page', 'output': 'related', 'element': ['div', 'class="xref"'],
+                       'pattern': 'href="/([^"]+)"'}],
+            'fields': ['page'],
+        }))
+        program.run('<a href="/no"></a><div class="xref"><a href="/one"></a><a href="/two-words"></a></div>', links)
+        self.assertEqual(['one', 'two-words'], links)
+
+    def test_load_rules(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'test.json')
+            with open(path, 'w', encoding='utf8') as fp:
+                json.dump(RULES, fp)
+            cache_dir = os.path.join(tmp, 'cache')
+            program = load_rules(path, cache_dir)
+            self.assertIs(program, load_rules(path, cache_dir))
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+
+            # compiled program is read back from the disk cache
+            rules._programs.clear()
+            self.assertEqual(program.run(PAGE), load_rules(path, cache_dir).run(PAGE))
@@ -0,0 +1,89 @@
+import csv
+import os
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from dict2anki.extractors.cambridge import CambridgeExtractor
+from dict2anki.extractors.extractor import WordNotFoundError, BACKENDS
+from dict2anki.snapshot import Snapshot, SnapshotWriter
+from dict2anki.utils import Log, get_tag
+
+TAG = get_tag(__name__)
+
+Log.level = Log.DEBUG
+
+PAGE = '''<html><body>
+<div class="di-body">
+    <div class="di-title"><span class="hw dhw">cater</span></div>
+    <span class="ipa">ˈkeɪ.tər</span>
+    <span class="daud"><source src="/zhs/media/english/us_pron/c/cat/cater.mp3"/></span>
+    <div class="xref">see also</div>
+    <div class="def-block ddef_block">to provide <a class="query" href="/x">food</a></div>
+</div>
+</body></html>'''
+
+
+class TestSnapshot(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.tmp.name, 'snapshot.zip')
+        self.rules_cache_dir = os.path.join(self.tmp.name, 'cache')
+        with SnapshotWriter(self.archive) as writer:
+            writer.add('cater to', 'cater', PAGE)
+            writer.add('cater', 'cater', PAGE)
+            writer.add_asset('styling', b'<style></style>')
+            writer.add_asset('media/_font.woff', b'font')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get(self):
+        with Snapshot(self.archive) as snapshot:
+            self.assertEqual(2, len(snapshot))
+            self.assertIn('  cater   to ', snapshot)
+            self.assertEqual(('cater', PAGE), snapshot.get('cater to'))
+            self.assertIsNone(snapshot.get('shiiiit'))
+            self.assertEqual(b'font', snapshot.get_asset('media/_font.woff'))
+
+    def test_offline_extractor(self):
+        out_path = os.path.join(self.tmp.name, 'out')
+        with Snapshot(self.archive) as snapshot:
+            extractor = CambridgeExtractor(out_path, snapshot=snapshot, rules_cache_dir=self.rules_cache_dir)
+            actual, (front, back) = extractor.get_card('cater to')
+            self.assertEqual('cater', actual)
+            self.assertIn('large-ipa', front)
+            self.assertNotIn('xref', back)
+            self.assertNotIn('<a ', back)
+            self.assertRaises(WordNotFoundError, extractor.get_card, 'shiiiit')
+            extractor.generate_styling()
+            extractor.generate_cards('cater to', 'cater', 'shiiiit')
+        self.assertTrue(os.path.isfile(os.path.join(out_path, 'collection.media', '_font.woff')))
+        with open(os.path.join(out_path, 'cards.txt'), encoding='utf8') as fp:
+            self.assertEqual(1, len(list(csv.reader(fp))))
+
+    def test_pickle(self):
+        with Snapshot(self.archive) as snapshot:
+            copy = pickle.loads(pickle.dumps(snapshot))
+            self.assertEqual(snapshot.get('cater'), copy.get('cater'))
+            copy.close()
+
+    def test_backends(self):
+        class CountingExecutor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                CountingExecutor.submitted += 1
+                return super().submit(*args, **kwargs)
+
+        words = ('cater to', 'cater', 'shiiiit')
+        with Snapshot(self.archive) as snapshot, CountingExecutor(2) as executor:
+            for backend in BACKENDS + (executor,):
+                out_path = os.path.join(self.tmp.name, str(backend))
+                extractor = CambridgeExtractor(out_path, snapshot=snapshot, backend=backend, workers=2, concurrency=2,
+                                               rules_cache_dir=self.rules_cache_dir)
+                self.assertTrue(extractor.generate(*words))
+                self.assertEqual(1, len(extractor._read_cards()))
+            self.assertEqual(len(words), CountingExecutor.submitted)
+        self.assertRaises(ValueError, CambridgeExtractor, backend='fibers', rules_cache_dir=self.rules_cache_dir)
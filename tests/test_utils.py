@@ -1,3 +1,7 @@
+import io
+import json
+import os
+import tempfile
 import time
 from unittest import TestCase
 
@@ -24,6 +28,43 @@ class TestUtils(TestCase):
         Log.w(TAG, 'warn log')
         Log.e(TAG, 'error log')
 
+    def test_Log_lazy(self):
+        class Counter:
+            count = 0
+
+            def __str__(self):
+                Counter.count += 1
+                return 'x' * 10000
+
+        Log.level = Log.INFO
+        Log.d(TAG, 'lazy {}', Counter())
+        self.assertEqual(0, Counter.count)
+        Log.level = Log.DEBUG
+        Log.d(TAG, 'lazy {}', Counter(), value=Counter())
+        self.assertEqual(2, Counter.count)
+
+    def test_Log_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'log.jsonl')
+            Log.level = Log.INFO
+            Log.open_file(path, Log.DEBUG)
+            try:
+                Log.d(TAG, 'debug {}', 'x' * 10000, word='test')
+                Log.i(TAG, 'info log')
+                # debug logs are left out of the file by default
+                Log.open_file(path)
+                self.assertFalse(Log.enabled(Log.DEBUG))
+                Log.d(TAG, 'not written')
+                Log.w(TAG, 'warn log')
+            finally:
+                Log.close_file()
+                Log.level = Log.DEBUG
+            with open(path, encoding='utf8') as fp:
+                records = [json.loads(line) for line in fp]
+        self.assertEqual(['D', 'I', 'W'], [r['level'] for r in records])
+        self.assertEqual('test', records[0]['word'])
+        self.assertLess(len(records[0]['msg']), 1000)
+
     def test_progress_bar(self):
         bar = ProgressBar()
         bar.update()
@@ -37,3 +78,20 @@ class TestUtils(TestCase):
         time.sleep(0.5)
         bar.increment(1)
         bar.done()
+
+    def test_progress_bar_rate_limit(self):
+        stream = io.StringIO()
+        bar = ProgressBar(10, interval=60, stream=stream)
+        bar.update()
+        bar.in_flight = 2
+        for _ in range(8):
+            bar.increment()
+        bar.fail()
+        bar.done()
+        lines = stream.getvalue().splitlines()
+        Log.d(TAG, lines)
+        self.assertEqual(2, len(lines))
+        self.assertIn('9 / 10', lines[-1])
+        self.assertIn('ETA', lines[-1])
+        self.assertIn('active 2', lines[-1])
+        self.assertIn('errors 1 (11.1%)', lines[-1])